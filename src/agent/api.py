@@ -6,12 +6,102 @@ import numpy as np
 import shutil
 
 from src.config import Config
+from src.environment.light.lookup_tables import ActionLabelsRed
 from src.utils.model_helper import load_best_model_weight, need_to_reload_best_model_weight
 from time import time
 from logging import getLogger
 
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8
+    shared_memory = None
+
 logger = getLogger(__name__)
 
+WAIT_TIMEOUT = 0.1  # seconds to block on the pipes before checking for a model reload or close
+KEY_MASK = (1 << 64) - 1
+SHM_DIR = '/dev/shm'  # backs multiprocessing.shared_memory on linux
+
+
+def table_key(key, last_key=None):
+    '''
+    64-bit key of a position in SharedEvalTable: its zobrist key mixed with the zobrist key of the
+    last state of its history planes. 0 marks an empty slot
+    '''
+    if last_key is not None:
+        key = (key ^ (last_key * 0x9E3779B97F4A7C15 + 1)) & KEY_MASK
+    return key or 1
+
+
+class SharedEvalTable:
+    '''
+    Fixed-size table of NN results (policy, value) in shared memory, indexed by table_key % slots
+    (a new result overwrites the slot). CChessModelAPI is the only writer, it fills the table after
+    every batch; the players of the self-play processes attach it by name and read it before they
+    queue a position. A slot is written under a sequence number, odd while being written,
+    so a reader drops the entries written during its read.
+    '''
+    def __init__(self, slots, name=None):
+        labels_n = len(ActionLabelsRed)
+        self.slots = slots
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=self.nbytes(slots))
+        buf = self.shm.buf
+        self.keys = np.ndarray((slots,), dtype=np.uint64, buffer=buf)
+        self.seqs = np.ndarray((slots,), dtype=np.uint32, buffer=buf, offset=8 * slots)
+        self.values = np.ndarray((slots,), dtype=np.float32, buffer=buf, offset=12 * slots)
+        self.policies = np.ndarray((slots, labels_n), dtype=np.float16, buffer=buf, offset=16 * slots)
+        self.hits = 0  # reads of this process
+        self.misses = 0
+
+    @staticmethod
+    def nbytes(slots):
+        return slots * (16 + 2 * len(ActionLabelsRed))
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def get(self, key):
+        '''
+        (policy, value) of `key` (see table_key), None on a miss
+        '''
+        slot = key % self.slots
+        seq = int(self.seqs[slot])
+        if seq & 1 or int(self.keys[slot]) != key:
+            self.misses += 1
+            return None
+        p = self.policies[slot].astype(np.float32)
+        v = float(self.values[slot])
+        if int(self.seqs[slot]) != seq or int(self.keys[slot]) != key:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return p, v
+
+    def put(self, keys, policies, values):
+        for key, p, v in zip(keys, policies, values):
+            if not key:
+                continue
+            slot = key % self.slots
+            self.seqs[slot] += 1
+            self.keys[slot] = key
+            self.values[slot] = v
+            self.policies[slot] = p
+            self.seqs[slot] += 1
+
+    def clear(self):
+        self.keys[:] = 0
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def close(self, unlink=False):
+        del self.keys, self.seqs, self.values, self.policies  # release the views of the buffer
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
 
 class CChessModelAPI:
 
@@ -21,6 +111,9 @@ class CChessModelAPI:
         self.config = config
         self.need_reload = True
         self.done = False
+        self.generation = 0  # bumped on every weights reload, sent with the results to invalidate the caches
+        self.table = None  # SharedEvalTable filled with the results, see create_table
+        self.shared_generation = None  # generation for the other processes, see share_generation
 
     def start(self, need_reload=True):
         self.need_reload = need_reload
@@ -34,16 +127,44 @@ class CChessModelAPI:
         self.need_reload = need_reload
         return you
 
+    def create_table(self, slots):
+        '''
+        Share the prediction results with the other processes, return the name of the table (None if disabled)
+        '''
+        if slots <= 0:
+            return None
+        if shared_memory is None:
+            logger.warning("multiprocessing.shared_memory needs python 3.8, the results are not shared")
+            return None
+        if self.table is None:
+            size = SharedEvalTable.nbytes(slots)
+            free = shutil.disk_usage(SHM_DIR).free if os.path.isdir(SHM_DIR) else size
+            if free < size:
+                # the pages are only allocated on write, a full /dev/shm kills the processes with SIGBUS
+                logger.warning(f"the table of {slots} slots needs {size >> 20} MB, {SHM_DIR} has {free >> 20} MB free, "
+                               f"the results are not shared")
+                return None
+            self.table = SharedEvalTable(slots)
+        return self.table.name
+
+    def share_generation(self, manager):
+        '''
+        Publish the model generation to the other processes, return the manager Value they poll
+        '''
+        if self.shared_generation is None:
+            self.shared_generation = manager.Value('i', self.generation)
+        return self.shared_generation
+
     def predict_batch_worker(self):
         last_model_check_time = time()
         while not self.done:
             if last_model_check_time + 600 < time() and self.need_reload:
                 self.try_reload_model()
                 last_model_check_time = time()
-            ready = connection.wait(self.pipes, timeout=0.001)
+            ready = connection.wait(self.pipes, timeout=WAIT_TIMEOUT)
             if not ready:
                 continue
-            data, result_pipes, data_len = [], [], []
+            data, keys, result_pipes, data_len = [], [], [], []
             for pipe in ready:
                 while pipe.poll():
                     try:
@@ -52,21 +173,25 @@ class CChessModelAPI:
                         logger.error(f"EOF error: {e}")
                         pipe.close()
                     else:
-                        data.extend(tmp)
-                        data_len.append(len(tmp))
+                        planes, planes_keys = tmp  # table_key of every position, 0 not to share it
+                        data.extend(planes)
+                        keys.extend(planes_keys)
+                        data_len.append(len(planes))
                         result_pipes.append(pipe)
             if not data:
                 continue
             data = np.asarray(data, dtype=np.float32)
             with self.agent_model.graph.as_default():
                 policy_ary, value_ary = self.agent_model.model.predict_on_batch(data)
+            if self.table is not None:
+                self.table.put(keys, policy_ary, np.ravel(value_ary))
             buf = []
             k, i = 0, 0
             for p, v in zip(policy_ary, value_ary):
                 buf.append((p, float(v)))
                 k += 1
                 if k >= data_len[i]:
-                    result_pipes[i].send(buf)
+                    result_pipes[i].send((buf, self.generation))
                     buf = []
                     k = 0
                     i += 1
@@ -79,8 +204,16 @@ class CChessModelAPI:
             if self.need_reload and need_to_reload_best_model_weight(self.agent_model):
                 with self.agent_model.graph.as_default():
                     load_best_model_weight(self.agent_model)
+                self.generation += 1
+                if self.table is not None:
+                    self.table.clear()
+                if self.shared_generation is not None:
+                    self.shared_generation.value = self.generation
         except Exception as e:
             self.error = logger.error(e)
 
     def close(self):
         self.done = True
+        if self.table is not None:
+            self.table.close(unlink=True)
+            self.table = None
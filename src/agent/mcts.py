@@ -1,174 +1,498 @@
-from collections import defaultdict
+from collections import OrderedDict
+from itertools import islice
 from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
-from threading import Lock
+from threading import Lock, Condition
 import concurrent.futures.thread
-from time import time, sleep
-import gc
+from time import time
 import sys
 import numpy as np
 
 
 import src.environment.light.static_env as senv
-from src.environment.light.lookup_tables import ActionLabelsRed, flip_move
+from src.environment.light.lookup_tables import ActionLabelsRed, flip_move, move_to_id
+from src.environment.light.planes import plane_indices, indices_to_planes, NO_STATE
+from src.agent.api import table_key
 from src.config import Config
 
 
 
 logger = getLogger(__name__)
 
+# results of CChessPlayer.descend
+EXPANDED, FINISHED, WAITING = range(3)
+RECEIVE_TIMEOUT = 0.1  # seconds the receiver blocks on the pipe before checking whether to stop
 
-class VisitState:
-    def __init__(self):
-        self.a = defaultdict(ActionState)  # key: action, value: ActionState
-        self.sum_n = 0  # visit count
-        self.visit = []  # thread id that has visited this state
-        self.p = None  # policy of this state
-        self.legal_moves = None  # all leagal moves of this state
-        self.waiting = False  # is waiting for NN's predict
-        self.w = 0
 
+class SearchTree:
+    '''
+    Struct-of-arrays search tree. Nodes are integer ids, looked up by zobrist key in `index`.
+    The edges of a node are the contiguous slice [first, first + count) of the edge arrays.
+    Arrays are preallocated and grow by chunks; it is not thread safe, callers hold a lock.
+    '''
+    node_chunk = 4096
+    edge_chunk = 131072
+    node_fields = ('sum_n', 'first', 'count', 'waiting')
+    edge_fields = ('move', 'n', 'w', 'q', 'p', 'child')
+    index_entry_bytes = 100  # approximate size of an entry of `index`
 
-class ActionState:
     def __init__(self):
-        self.n = 0  # N(s, a) : visit count
-        self.w = 0  # W(s, a) : total action value
-        self.q = 0  # Q(s, a) = N / W : action value
-        self.p = 0  # P(s, a) : prior probability
+        self.index = {}  # key: zobrist key, value: node id
+        self.visit = {}  # key: node id, value: [(position, history)] of searches waiting for its prediction
+        self.num_nodes = 0
+        self.num_edges = 0
+        self.hits = 0  # searches that reached an expanded node
+        self.misses = 0  # searches that expanded a node
+        self.evictions = 0  # nodes evicted to bound the memory
+        # nodes
+        self.sum_n = np.zeros(self.node_chunk, dtype=np.int32)  # visit count
+        self.first = np.zeros(self.node_chunk, dtype=np.int64)  # first edge
+        self.count = np.zeros(self.node_chunk, dtype=np.int16)  # number of edges (legal moves)
+        self.waiting = np.zeros(self.node_chunk, dtype=np.bool_)  # is waiting for NN's predict
+        # edges
+        self.move = np.zeros(self.edge_chunk, dtype=np.int16)  # move id
+        self.n = np.zeros(self.edge_chunk, dtype=np.int32)  # N(s, a) : visit count
+        self.w = np.zeros(self.edge_chunk, dtype=np.float64)  # W(s, a) : total action value
+        self.q = np.zeros(self.edge_chunk, dtype=np.float64)  # Q(s, a) = W / N : action value
+        self.p = np.zeros(self.edge_chunk, dtype=np.float32)  # P(s, a) : prior probability
+        self.child = np.zeros(self.edge_chunk, dtype=np.int32)  # node reached by the edge, -1 if not searched yet
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return self.num_nodes
+
+    def get(self, key):
+        return self.index.get(key)
+
+    def probe(self, key):
+        '''
+        get() for the search, counts hits and misses
+        '''
+        node = self.index.get(key)
+        if node is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return node
+
+    def edges(self, node):
+        first = int(self.first[node])
+        return slice(first, first + int(self.count[node]))
+
+    @staticmethod
+    def _grow(array, size, chunk):
+        grown = np.zeros(max(len(array) + max(chunk, len(array) // 2), size), dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    def add(self, key, legal_moves):
+        '''
+        Expand a node with the legal moves of its position, return its id
+        '''
+        node, first = self.num_nodes, self.num_edges
+        if node >= len(self.sum_n):
+            for name in self.node_fields:
+                setattr(self, name, self._grow(getattr(self, name), node + 1, self.node_chunk))
+        end = first + len(legal_moves)
+        if end > len(self.move):
+            for name in self.edge_fields:
+                setattr(self, name, self._grow(getattr(self, name), end, self.edge_chunk))
+        self.num_nodes += 1
+        self.num_edges = end
+        self.index[key] = node
+        self.sum_n[node] = 1
+        self.first[node] = first
+        self.count[node] = len(legal_moves)
+        self.waiting[node] = True
+        self.move[first:end] = legal_moves
+        self.child[first:end] = -1
+        for array in (self.n, self.w, self.q, self.p):  # may hold the edges of compacted nodes
+            array[first:end] = 0
+        return node
+
+    def set_prior(self, node, policy):
+        '''
+        Push the NN policy to the edges, renormalised over the legal moves
+        '''
+        s = self.edges(node)
+        p = np.asarray(policy)[self.move[s]]
+        total = p.sum()
+        self.p[s] = p / (total if total != 0 else 1)
+        self.waiting[node] = False
+
+    def priors(self, node):
+        '''
+        (move ids, priors) of the edges; the edge order depends on the side to move
+        '''
+        s = self.edges(node)
+        return self.move[s].copy(), self.p[s].copy()
+
+    def clear(self):
+        self.index = {}
+        self.visit = {}
+        self.num_nodes = 0
+        self.num_edges = 0
+
+    def reroot(self, key):
+        '''
+        Keep only the subtree of the node `key` (the nodes reachable through the searched edges),
+        the kept nodes and their edges are renumbered to the front of the arrays
+        '''
+        root = self.index.get(key)
+        if root is None:
+            self.clear()
+            return
+        kept = np.zeros(self.num_nodes, dtype=np.bool_)
+        kept[root] = True
+        frontier = np.asarray([root])
+        while len(frontier):
+            children = self.child[_ranges(self.first[frontier], self.count[frontier])]
+            children = np.unique(children[children >= 0])
+            frontier = children[~kept[children]]
+            kept[frontier] = True
+        self._compact(kept)
+
+    def evict(self, max_nodes, max_bytes, keep=None):
+        '''
+        If the tree holds more than `max_nodes` nodes or `max_bytes` bytes, evict the least visited
+        nodes (never `keep` or a node waiting for its prediction) down to 90% of the limits.
+        The edges that led to an evicted node are kept, the node is expanded again if searched.
+        Only call it while no search is running, edge ids change. Return the number of evicted nodes
+        '''
+        if self.num_nodes <= max_nodes and self.used_bytes <= max_bytes:
+            return 0
+        num = self.num_nodes
+        sum_n = self.sum_n[:num].astype(np.int64)
+        if keep is not None and keep in self.index:
+            sum_n[self.index[keep]] = np.iinfo(np.int64).max
+        sum_n[self.waiting[:num]] = np.iinfo(np.int64).max
+        order = np.argsort(-sum_n, kind='stable')  # most visited first
+        size = np.cumsum(self.count[order].astype(np.int64) * self.edge_bytes + self.node_bytes)
+        limit = min(int(max_nodes * 0.9), int(np.searchsorted(size, max_bytes * 0.9, side='right')))
+        limit = max(limit, int(np.count_nonzero(sum_n == np.iinfo(np.int64).max)))
+        kept = np.zeros(num, dtype=np.bool_)
+        kept[order[:limit]] = True
+        self._compact(kept)
+        self.evictions += num - self.num_nodes
+        return num - self.num_nodes
+
+    def _compact(self, kept):
+        '''
+        Keep the nodes of the boolean mask `kept`, renumbered with their edges to the front of the arrays,
+        edges that led to a dropped node are reset
+        '''
+        nodes = np.nonzero(kept)[0]
+        if len(nodes) == self.num_nodes:
+            return
+        new_id = np.full(self.num_nodes, -1, dtype=np.int32)
+        new_id[nodes] = np.arange(len(nodes), dtype=np.int32)
+        counts = self.count[nodes].astype(np.int64)
+        edges = _ranges(self.first[nodes], counts)
+        num_edges = len(edges)
+        for name in self.edge_fields:
+            array = getattr(self, name)
+            array[:num_edges] = array[edges]
+        child = self.child[:num_edges]
+        child[child >= 0] = new_id[child[child >= 0]]
+        for name in ('sum_n', 'count', 'waiting'):
+            array = getattr(self, name)
+            array[:len(nodes)] = array[nodes]
+        self.first[:len(nodes)] = np.cumsum(counts) - counts
+        self.index = {k: int(new_id[node]) for k, node in self.index.items() if kept[node]}
+        self.visit = {int(new_id[node]): v for node, v in self.visit.items() if kept[node]}
+        self.num_nodes = len(nodes)
+        self.num_edges = num_edges
+
+    @property
+    def node_bytes(self):
+        return sum(getattr(self, name).itemsize for name in self.node_fields) + self.index_entry_bytes
+
+    @property
+    def edge_bytes(self):
+        return sum(getattr(self, name).itemsize for name in self.edge_fields)
+
+    @property
+    def used_bytes(self):
+        '''
+        approximate memory used by the nodes in the tree
+        '''
+        return self.num_nodes * self.node_bytes + self.num_edges * self.edge_bytes
+
+    @property
+    def nbytes(self):
+        '''
+        memory allocated by the arrays
+        '''
+        return sum(getattr(self, name).nbytes for name in self.node_fields + self.edge_fields)
+
+
+class EvalCache:
+    '''
+    LRU cache of the NN results ((move ids, priors) of the legal moves, value), keyed by the zobrist
+    key of the position and of the last state of its history planes. Shared by the players of a
+    process; emptied when the model generation (see CChessModelAPI.generation) moves: on an answer of
+    a newer model or, with `generation` (the manager Value of CChessModel.get_generation), by sync
+    '''
+    def __init__(self, size, generation=None):
+        self.size = size
+        self.entries = OrderedDict()
+        self.generation = None  # model generation of the cached results
+        self.model_generation = generation
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            ret = self.entries.get(key)
+            if ret is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return ret
+
+    def sync(self):
+        '''
+        Drop the results of an older model once the API reloaded its weights, before every search:
+        a search answered from the cache only would not get the answers of the new model
+        '''
+        if self.model_generation is None:
+            return
+        generation = self.model_generation.value
+        with self.lock:
+            if self.generation is None or generation > self.generation:
+                self.entries.clear()
+                self.generation = generation
+
+    def put(self, key, ret, generation):
+        with self.lock:
+            if generation != self.generation:
+                if self.generation is not None and generation < self.generation:
+                    return  # answered by the previous model
+                self.entries.clear()
+                self.generation = generation
+            self.entries[key] = ret
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+
+def _ranges(starts, counts):
+    '''
+    concatenation of range(start, start + count) for every (start, count)
+    '''
+    counts = np.asarray(counts, dtype=np.int64)
+    ends = np.cumsum(counts)
+    return np.repeat(np.asarray(starts, dtype=np.int64) - ends + counts, counts) + np.arange(ends[-1] if len(ends) else 0)
 
 
 class CChessPlayer:
     def __init__(self, config: Config, search_tree=None, pipes=None, play_config=None,
-                 enable_resign=False, debugging=False, uci=False, use_history=False):
+                 enable_resign=False, debugging=False, uci=False, use_history=False, eval_cache=None,
+                 eval_table=None):
         self.config = config
+        senv.set_backend(config.opts.env_backend)
         self.play_config = play_config or self.config.play
         self.labels_n = len(ActionLabelsRed)
-        self.labels = ActionLabelsRed
-        self.move_lookup = {move: i for move, i in zip(self.labels, range(self.labels_n))}
+        self.labels = ActionLabelsRed  # move strings of the move ids, for the UCI output
         self.pipe = pipes  # pipes that used to communicate with CChessModelAPI thread
-        self.node_lock = defaultdict(Lock)  # key: state key, value: Lock of that state
+        self.tree_lock = Lock()  # guards the search tree
         self.use_history = use_history
+        self.eval_cache = eval_cache  # EvalCache of the NN results, None not to cache
+        self.eval_table = eval_table  # SharedEvalTable of the prediction server, None not to read it
         self.increase_temp = False
 
         if search_tree is None:
-            self.tree = defaultdict(VisitState)  # key: state key, value: VisitState
+            self.tree = SearchTree()
         else:
             self.tree = search_tree
 
-        self.root_state = None
+        self.root = None  # position searched
+        self.root_key = None
+        self.root_noise = None  # dirichlet noise of the root edges, drawn once per search
+        self.noise_eps = self.play_config.noise_eps  # weight of root_noise in the searched move, 0 for none
+        self.real_hist = None  # [position, move, position, move, root position] of the game
 
         self.enable_resign = enable_resign
         self.debugging = debugging
 
         self.search_results = {}  # for debug
-        self.debug = {}
+        self.debug = {}  # key: zobrist key, value: (policy, value) of NN
 
         self.s_lock = Lock()
-        self.run_lock = Lock()
         self.q_lock = Lock()  # queue lock
+        self.q_cond = Condition(self.q_lock)  # notified when leaves are queued, a request is answered or on close
+        self.sent = 0  # leaves at the front of the queue sent in the request not answered yet
+        self.flush_time = 0  # time to send the pending leaves even if there are less than flush_leaves
+        # a search batch has at most search_threads leaves
+        self.flush_leaves = min(self.play_config.flush_leaves, self.play_config.search_threads)
         self.t_lock = Lock()
-        self.buffer_planes = []  # prediction queue
+        self.buffer_states = []  # prediction queue: positions to evaluate
+        self.buffer_lasts = []  # last states of buffer_states for history planes: zobrist key, position or None
+        self.plane_cache = {}  # key: zobrist key, value: plane indices of that position, see planes.plane_indices
         self.buffer_history = []
 
         self.all_done = Lock()
         self.num_task = 0
         self.done_tasks = 0
+        self.started = 0  # simulations started by the batched driver
+        self.start_time = 0
+        self.start_done = 0  # done_tasks when the search started (visits reused from the previous moves)
+        self.max_done = 0  # done_tasks at the end of the node budget
+        self.deadline = None  # end of the time budget
+        self.early_stop = False
+        self.kl_adaptive = False
+        self.kl_snapshot = None  # root visit distribution at kl_done
+        self.kl_done = 0
+        self.kl_gain = None  # KL divergence per simulation of the last two snapshots
+        self.resumed = []  # (position, history) of batched searches whose waited prediction has arrived
         self.uci = uci
         self.no_act = None
 
         self.job_done = False
 
-        self.executor = ThreadPoolExecutor(max_workers=self.play_config.search_threads + 2)
-        self.executor.submit(self.receiver)
-        self.executor.submit(self.sender)
+        self.executor = None  # the batched driver searches in the calling thread
+        if self.play_config.search_driver == 'threads':
+            self.executor = ThreadPoolExecutor(max_workers=self.play_config.search_threads + 2)
+            self.executor.submit(self.receiver)
+            self.executor.submit(self.sender)
 
     def close(self, wait=True):
-        self.job_done = True
+        self.stop_threads()
         del self.tree
-        gc.collect()
+        del self.plane_cache
         if self.executor is not None:
             self.executor.shutdown(wait=wait)
 
     def close_and_return_action(self, state, turns, no_act=None):
-        self.job_done = True
+        self.stop_threads()
         if self.executor is not None:
             self.executor.shutdown(wait=False)
             # self.executor = None
             self.executor._threads.clear()
             concurrent.futures.thread._threads_queues.clear()
-        policy, resign = self.calc_policy(state, turns, no_act)
+        key = senv.new_position(state).key
+        if no_act is not None:
+            no_act = [move_to_id(act) for act in no_act]
+        policy, resign = self.calc_policy(key, turns, no_act)
         if resign:  # resign
             return None
         if no_act is not None:
             for act in no_act:
-                policy[self.move_lookup[act]] = 0
+                policy[act] = 0
         my_action = int(np.random.choice(range(self.labels_n), p=self.apply_temperature(policy, turns)))
-        if state in self.debug:
-            _, value = self.debug[state]
+        if key in self.debug:
+            _, value = self.debug[key]
         else:
             value = 0
         return self.labels[my_action], value, self.done_tasks // 100
 
+    def stop_threads(self):
+        with self.q_cond:
+            self.job_done = True
+            self.q_cond.notify_all()
+
     def sender(self):
         '''
-        send planes to neural network for prediction
+        send planes to neural network for prediction, one request at a time: when flush_leaves
+        leaves are pending, or when the oldest pending leaf has waited flush_timeout_us
         '''
         limit = 256  # max prediction queue size
-        while not self.job_done:
-            self.run_lock.acquire()
-            with self.q_lock:
+        out = np.zeros(shape=(limit, 28 if self.use_history else 14, 10, 9), dtype=np.float32)
+        with self.q_cond:
+            while not self.job_done:
+                if self.sent or not self.buffer_states:
+                    self.q_cond.wait()
+                    continue
+                wait = self.flush_time - time()
+                if len(self.buffer_states) < self.flush_leaves and wait > 0:
+                    self.q_cond.wait(wait)
+                    continue
                 l = min(limit, len(self.buffer_history))
-                if l > 0:
-                    t_data = self.buffer_planes[0:l]
-                    # logger.debug(f"send queue size = {l}")
-                    self.pipe.send(t_data)
-                else:
-                    self.run_lock.release()
-                    sleep(0.001)
+                t_data = self.encode(self.buffer_states[0:l], self.buffer_lasts[0:l], out[:l])
+                # logger.debug(f"send queue size = {l}")
+                self.sent = l
+                self.pipe.send((t_data, self.table_keys(self.buffer_states[0:l], self.buffer_lasts[0:l])))
+
+    def encode(self, states, lasts, out):
+        '''
+        Encode the prediction queue into `out`. Plane indices are cached by zobrist key, so the
+        last state of a node is copied from its already encoded ancestor instead of re-parsed
+        '''
+        cache = self.plane_cache
+        missing = {}  # key: zobrist key, value: position to encode
+        for state in states:
+            if state.key not in cache:
+                missing[state.key] = state
+        if self.use_history:
+            for state, last in zip(states, lasts):
+                if last is None:
+                    continue
+                key = last if isinstance(last, int) else last.key
+                if key not in cache and key not in missing:
+                    # evicted ancestor: rebuild it by unmaking the last two moves
+                    missing[key] = state.previous() if isinstance(last, int) else last
+        if missing:
+            for key, indices in zip(missing, plane_indices(list(missing.values())).astype(np.int8)):
+                cache[key] = indices
+        indices = np.stack([cache[state.key] for state in states])
+        last_indices = None
+        if self.use_history:
+            last_indices = np.stack([NO_STATE if last is None else cache[last if isinstance(last, int) else last.key]
+                                     for last in lasts])
+        excess = len(cache) - self.play_config.max_plane_cache
+        if excess > 0:  # evict the oldest positions
+            for key in list(islice(cache, excess)):
+                del cache[key]
+        return indices_to_planes(indices, last_indices, out)
 
     def receiver(self):
         '''
         receive policy and value from neural network
         '''
         while not self.job_done:
-            if self.pipe.poll(0.001):
-                rets = self.pipe.recv()
-            else:
+            if not self.pipe.poll(RECEIVE_TIMEOUT):  # blocks until the answer, wakes up to check job_done
                 continue
+            rets, generation = self.pipe.recv()
             k = 0
-            with self.q_lock:
+            with self.q_cond:
                 for ret in rets:
                     # logger.debug(f"NN ret, update tree buffer_history = {self.buffer_history}")
-                    self.executor.submit(self.update_tree, ret[0], ret[1], self.buffer_history[k])
-                    # self.update_tree(ret[0], ret[1], self.buffer_history[k])
+                    leaf = (self.buffer_states[k], self.buffer_lasts[k], generation)
+                    self.executor.submit(self.update_tree, ret[0], ret[1], self.buffer_history[k], leaf)
                     k = k + 1
-                self.buffer_planes = self.buffer_planes[k:]
+                self.buffer_states = self.buffer_states[k:]
+                self.buffer_lasts = self.buffer_lasts[k:]
                 self.buffer_history = self.buffer_history[k:]
-            self.run_lock.release()
+                self.sent = 0
+                self.q_cond.notify_all()
 
-    def action(self, state, turns, no_act=None, depth=None, infinite=False, hist=None, increase_temp=False) -> str:
+    def action(self, state, turns, no_act=None, depth=None, infinite=False, hist=None, increase_temp=False,
+               movetime=None, noise=True) -> str:
+        '''
+        Search `state` and pick a move. Budgets: `depth` simulations (default simulation_num_per_move)
+        and `movetime` seconds (default play_config.move_time, 0 for none), the search stops at
+        whichever runs out first, see stop_search.
+        `noise`: add the dirichlet noise to the root priors
+        '''
         self.all_done.acquire(True)
-        self.root_state = state
-        self.no_act = no_act
-        self.increase_temp = increase_temp
-        if hist and len(hist) >= 5:
-            hist = hist[-5:]
-        done = 0
-        if state in self.tree:
-            done = self.tree[state].sum_n
-        if no_act or increase_temp:
-            # logger.info(f"no_act = {no_act}, increase_temp = {increase_temp}")
-            done = 0
-        self.done_tasks = done
-        self.num_task = self.play_config.simulation_num_per_move - done
-        if depth:
-            self.num_task = depth - done if depth > done else 0
-        if infinite:
-            self.num_task = 100000
+        root = self.start_search(state, turns, no_act, depth, infinite, hist, increase_temp, movetime, noise)
         depth = 0
-        start_time = time()
+        start_time = self.start_time
         # MCTS search
-        if self.num_task > 0:
+        if self.num_task > 0 and self.executor is None:
+            self.batched_search(root, turns, start_time)
+        elif self.num_task > 0:
             all_tasks = self.num_task
             batch = all_tasks // self.config.play.search_threads
             if all_tasks % self.config.play.search_threads != 0:
@@ -179,192 +503,380 @@ class CChessPlayer:
                 self.done_tasks += self.num_task
                 # logger.debug(f"iter = {iter}, num_task = {self.num_task}")
                 for i in range(self.num_task):
-                    self.executor.submit(self.MCTS_search, state, [state], True, hist)
+                    self.executor.submit(self.MCTS_search, root.copy(), [self.root_key])
                 self.all_done.acquire(True)
-                if self.uci and depth != self.done_tasks // 100:
-                    # info depth xx pv xxx
-                    depth = self.done_tasks // 100
-                    _, value = self.debug[state]
-                    self.print_depth_info(state, turns, start_time, value, no_act)
+                depth = self.after_batch(root, turns, start_time, depth)
+                if self.stop_search():
+                    break
         self.all_done.release()
+        return self.choose_action(turns)
+
+    def start_search(self, state, turns, no_act=None, depth=None, infinite=False, hist=None, increase_temp=False,
+                     movetime=None, noise=True):
+        '''
+        Set up the search of the move of `state`: reroot the tree, count the simulations to run.
+        return the root position
+        '''
+        root = senv.new_position(state)
+        key = root.key
+        self.root_key = key
+        self.root_noise = None
+        self.noise_eps = self.play_config.noise_eps if noise else 0
+        if self.eval_cache is not None:
+            self.eval_cache.sync()
+        if not self.play_config.share_mtcs_info_in_self_play:
+            self.reroot(key)
+        if no_act is not None:
+            no_act = [move_to_id(act) for act in no_act]
+        self.no_act = no_act
+        self.increase_temp = increase_temp
+        self.real_hist = None
+        if hist:
+            # the last two moves of the game up to the root, for the history planes
+            self.real_hist = [senv.new_position(h) if i % 2 == 0 else h for i, h in enumerate(hist[-5:])]
+        done = 0
+        if key in self.tree:
+            done = int(self.tree.sum_n[self.tree.get(key)])
+        if no_act or increase_temp:
+            # logger.info(f"no_act = {no_act}, increase_temp = {increase_temp}")
+            done = 0
+        self.done_tasks = done
+        self.num_task = self.play_config.simulation_num_per_move - done
+        if depth:
+            self.num_task = depth - done if depth > done else 0
+        # KL-adaptive search: up to kl_max_simulations, until the root visits converge
+        self.kl_adaptive = self.play_config.kl_adaptive and not infinite and not depth
+        if self.kl_adaptive:
+            self.num_task = max(self.play_config.kl_max_simulations - done, 0)
+        self.kl_snapshot = None
+        self.kl_done = done
+        self.kl_gain = None
+        if movetime is None:
+            movetime = self.play_config.move_time
+        if infinite:
+            self.num_task = 100000
+        self.start_time = time()
+        self.start_done = done
+        self.max_done = done + self.num_task  # done_tasks at the end of the node budget
+        self.deadline = self.start_time + movetime if movetime else None
+        # stopping early does not change an argmax choice, a sampled move needs the whole search
+        self.early_stop = self.play_config.early_stop and not infinite and self.temperature(turns) == 0
+        self.root = root
+        self.started = 0
+        self.resumed = []
+        return root
 
-        policy, resign = self.calc_policy(state, turns, no_act)
+    def choose_action(self, turns):
+        '''
+        Pick the move of the searched root from its visit counts
+        return (move id or None to resign, policy)
+        '''
+        no_act = self.no_act
+        if self.kl_adaptive:
+            gain = f"{self.kl_gain:.2e}" if self.kl_gain is not None else None
+            logger.debug(f"kl adaptive search: {self.done_tasks} simulations ({self.done_tasks - self.start_done} new), "
+                         f"kl gain = {gain}")
+        policy, resign = self.calc_policy(self.root_key, turns, no_act)
 
         if resign:  # resign
             return None, list(policy)
         if no_act is not None:
             for act in no_act:
-                policy[self.move_lookup[act]] = 0
+                policy[act] = 0
 
         my_action = int(np.random.choice(range(self.labels_n), p=self.apply_temperature(policy, turns)))
-        return self.labels[my_action], list(policy)
+        return my_action, list(policy)
+
+    def batched_search(self, root, turns, start_time):
+        '''
+        Single-threaded search driver: descend up to search_threads times with virtual loss,
+        evaluate the collected leaves with one request, back them all up, repeat until
+        num_task simulations are done. Searches that reached a leaf being evaluated resume
+        in the next round, so every simulation ends in exactly one backup as with the threads
+        '''
+        batch_size = self.play_config.search_threads
+        out = np.zeros(shape=(batch_size, 28 if self.use_history else 14, 10, 9), dtype=np.float32)
+        depth = 0
+        while not self.search_done():
+            leaves = self.collect_leaves(batch_size)
+            if leaves:
+                states, lasts, _ = zip(*leaves)
+                self.pipe.send((self.encode(states, lasts, out[:len(leaves)]), self.table_keys(states, lasts)))
+                self.apply_predictions(leaves, *self.pipe.recv())
+            if not self.resumed:
+                depth = self.after_batch(root, turns, start_time, depth)
+
+    def search_done(self):
+        return not self.resumed and (self.started >= self.num_task or self.stop_search())
 
-    def MCTS_search(self, state, history=[], is_root_node=False, real_hist=None) -> float:
+    def stop_search(self):
+        '''
+        Between two search batches: stop once the time budget is spent, with early_stop once the
+        most visited root move cannot be overtaken with the simulations left, with kl_adaptive once
+        the root visit distribution has converged
+        '''
+        now = time()
+        if self.deadline is not None and now >= self.deadline:
+            return True
+        if not self.early_stop and not self.kl_adaptive:
+            return False
+        tree = self.tree
+        with self.tree_lock:
+            node = tree.get(self.root_key)
+            if node is None or tree.waiting[node]:
+                return False
+            edges = tree.edges(node)
+            n = tree.n[edges]
+            if self.no_act:
+                n = n[~np.isin(tree.move[edges], self.no_act)]
+        if len(n) == 0 or n.sum() == 0:
+            return False
+        if self.early_stop:
+            if len(n) == 1:
+                return True  # forced move
+            left = self.max_done - self.done_tasks
+            if self.deadline is not None and self.done_tasks > self.start_done:
+                rate = (self.done_tasks - self.start_done) / max(now - self.start_time, 1e-6)
+                left = min(left, rate * (self.deadline - now))
+            second, best = np.partition(n, len(n) - 2)[-2:]
+            if best - second > left:
+                return True
+        if self.kl_adaptive:
+            self.update_kl_gain(n)
+            return self.kl_gain is not None and self.kl_gain < self.play_config.kl_threshold and \
+                self.done_tasks >= self.play_config.kl_min_simulations
+        return False
+
+    def update_kl_gain(self, n):
+        '''
+        Every kl_interval simulations, snapshot the root visit distribution; kl_gain is the
+        KL divergence of the previous snapshot from the new one per simulation in between
+        '''
+        if self.done_tasks < self.kl_done + self.play_config.kl_interval:
+            return
+        visits = n / n.sum()
+        if self.kl_snapshot is not None:
+            old = self.kl_snapshot
+            seen = old > 0  # visits only grow, visits[seen] > 0
+            kl = float(np.sum(old[seen] * np.log(old[seen] / visits[seen])))
+            self.kl_gain = kl / (self.done_tasks - self.kl_done)
+        self.kl_snapshot = visits
+        self.kl_done = self.done_tasks
+
+    def collect_leaves(self, batch_size):
+        '''
+        One round of the batched search: resume the searches whose prediction arrived and start
+        new ones, up to batch_size descents. Terminal values are backed up at once.
+        return the leaves [(position, last state, history)] to evaluate
+        '''
+        new = min(batch_size - len(self.resumed), self.num_task - self.started)
+        searches = self.resumed + [(self.root.copy(), [self.root_key]) for _ in range(new)]
+        self.started += new
+        self.done_tasks += new
+        self.resumed = []
+        leaves = []
+        values = []  # (value, history) to back up
+        for state, history in searches:
+            result, v = self.descend(state, history)
+            if result == EXPANDED:
+                last = self.last_state(history)
+                ret = self.lookup(state, last)
+                if ret is None:
+                    leaves.append((state, last, history))
+                    continue
+                p, v = ret
+                self.resumed.extend(self.set_prediction(history[-1], p, v))
+                values.append((v, history))
+            elif result == FINISHED:
+                values.append((v, history))
+        for v, history in values:
+            self.backup(v, history)
+        return leaves
+
+    def apply_predictions(self, leaves, rets, generation=None):
+        '''
+        Store the predictions [(policy, value)] of the leaves from collect_leaves and back them up
+        '''
+        for (p, v), (state, last, history) in zip(rets, leaves):
+            self.resumed.extend(self.set_prediction(history[-1], p, v))
+            self.cache_prediction(state, last, v, generation)
+            self.backup(v, history)
+
+    def after_batch(self, root, turns, start_time, depth):
+        '''
+        Between two search batches: bound the tree, print the uci info of every 100 simulations
+        '''
+        self.bound_tree()
+        if self.uci and depth != self.done_tasks // 100:
+            # info depth xx pv xxx
+            depth = self.done_tasks // 100
+            _, value = self.debug[self.root_key]
+            self.print_depth_info(root, turns, start_time, value, self.no_act)
+        return depth
+
+    def reroot(self, key):
+        '''
+        Keep the subtree of the new root `key` for the search, free the rest of the tree
+        and the encoded planes and NN results of the freed positions
+        '''
+        with self.tree_lock:
+            self.tree.reroot(key)
+            self.drop_freed()
+
+    def bound_tree(self):
+        '''
+        Evict the least visited nodes when the tree exceeds max_nodes / max_bytes, between two
+        search batches (no search is running)
+        '''
+        tree = self.tree
+        with self.tree_lock:
+            evicted = tree.evict(self.play_config.max_nodes, self.play_config.max_bytes, keep=self.root_key)
+            if evicted:
+                self.drop_freed()
+                logger.debug(f"evicted {evicted} nodes, tree = {len(tree)} nodes / {tree.used_bytes >> 20} MB, "
+                             f"hits = {tree.hits}, misses = {tree.misses}, evictions = {tree.evictions}")
+
+    def drop_freed(self):
+        '''
+        Drop the encoded planes and NN results of the positions no longer in the tree
+        '''
+        for cache in (self.plane_cache, self.debug):
+            for k in [k for k in cache if k not in self.tree]:
+                del cache[k]
+
+    def MCTS_search(self, state, history) -> float:
         """
-        Monte Carlo Tree Search
+        Monte Carlo Tree Search, `state` is a Position owned by this search, moves are pushed onto it.
+        history holds [key, edge, key, ..., key] of the path from the root
         """
+        result, v = self.descend(state, history)
+        if result == EXPANDED:
+            self.expand_and_evaluate(state, history)
+        elif result == FINISHED:
+            self.executor.submit(self.update_tree, None, v, history)
+
+    def descend(self, state, history):
+        '''
+        Select down from `state` with virtual loss until a node to expand, a terminal position,
+        a loop or a node waiting for its prediction (the search is then queued in tree.visit).
+        return (EXPANDED, None), (FINISHED, value to back up) or (WAITING, None)
+        '''
+        tree = self.tree
+        virtual_loss = self.config.play.virtual_loss
         while True:
             # logger.debug(f"start MCTS, state = {state}, history = {history}")
-            game_over, v, _ = senv.done(state)
+            game_over, v, _ = state.done()
             if game_over:
-                self.executor.submit(self.update_tree, None, v, history)
-                break
+                return FINISHED, v
 
-            with self.node_lock[state]:
-                if state not in self.tree:
+            key = state.key
+            with self.tree_lock:
+                node = tree.probe(key)
+                expand = node is None
+                if expand:
+                    node = tree.add(key, state.get_legal_moves())
+                if len(history) > 1:
+                    tree.child[history[-2]] = node  # link the searched edge to its node
+                if expand:
                     # Expand and Evaluate
-                    self.tree[state].sum_n = 1
-                    self.tree[state].legal_moves = senv.get_legal_moves(state)
-                    self.tree[state].waiting = True
-                    # logger.debug(f"expand_and_evaluate {state}, sum_n = {self.tree[state].sum_n}, history = {history}")
-                    if is_root_node and real_hist:
-                        self.expand_and_evaluate(state, history, real_hist)
-                    else:
-                        self.expand_and_evaluate(state, history)
-                    break
+                    return EXPANDED, None
 
-                if state in history[:-1]:  # loop -> loss
+                if key in history[:-1]:  # loop -> loss
                     # logger.debug(f"loop -> loss, state = {state}, history = {history[:-1]}")
-                    self.executor.submit(self.update_tree, None, 0, history)
-                    break
+                    return FINISHED, 0
 
                 # Select
-                node = self.tree[state]
-                if node.waiting:
-                    node.visit.append(history)
+                if tree.waiting[node]:
+                    tree.visit.setdefault(node, []).append((state, history))
                     # logger.debug(f"wait for prediction state = {state}")
-                    break
+                    return WAITING, None
 
-                sel_action = self.select_action_q_and_u(state, is_root_node)
-
-                virtual_loss = self.config.play.virtual_loss
-                self.tree[state].sum_n += 1
-                # logger.debug(f"node = {state}, sum_n = {node.sum_n}")
-
-                action_state = self.tree[state].a[sel_action]
-                action_state.n += virtual_loss
-                action_state.w -= virtual_loss
-                action_state.q = action_state.w / action_state.n
-
-                # logger.debug(f"apply virtual_loss = {virtual_loss}, as.n = {action_state.n}, w = {action_state.w}, q = {action_state.q}")
-
-                # if action_state.next is None:
-                history.append(sel_action)
-                state = senv.step(state, sel_action)
-                history.append(state)
-                # logger.debug(f"step action {sel_action}, next = {action_state.next}")
-
-            # history.append(sel_action)
-            # state = action_state.next
-            # history.append(state)
-
-    def select_action_q_and_u(self, state, is_root_node) -> str:
-        '''
-        Select an action with highest Q(s,a) + U(s,a)
-        '''
-        is_root_node = self.root_state == state
-        # logger.debug(f"select_action_q_and_u for {state}, root = {is_root_node}")
-        node = self.tree[state]
-        legal_moves = node.legal_moves
-
-        # push p, the prior probability to the edge (node.p), only consider legal moves
-        if node.p is not None:
-            all_p = 0
-            for mov in legal_moves:
-                mov_p = node.p[self.move_lookup[mov]]
-                node.a[mov].p = mov_p
-                all_p += mov_p
-            # rearrange the distribution
-            if all_p == 0:
-                all_p = 1
-            for mov in legal_moves:
-                node.a[mov].p /= all_p
-            # release the temp policy
-            node.p = None
-
-        # sqrt of sum(N(s, b); for all b)
-        xx_ = np.sqrt(node.sum_n + 1)
-
-        e = self.play_config.noise_eps
-        c_puct = self.play_config.c_puct
-        dir_alpha = self.play_config.dirichlet_alpha
-
-        best_score = -99999999
-        best_action = None
-        move_counts = len(legal_moves)
-
-        for mov in legal_moves:
-            if is_root_node and self.no_act and mov in self.no_act:
-                # logger.debug(f"mov = {mov}, no_act = {self.no_act}, continue")
-                continue
-            action_state = node.a[mov]
-            p_ = action_state.p
-            if is_root_node:
-                p_ = (1 - e) * p_ + e * np.random.dirichlet(dir_alpha * np.ones(move_counts))[0]
-            # Q + U
-            score = action_state.q + c_puct * p_ * xx_ / (1 + action_state.n)
-            # if score > 0.1 and is_root_node:
-            #     logger.debug(f"U+Q = {score:.2f}, move = {mov}, q = {action_state.q:.2f}")
-            if action_state.q > (1 - 1e-7):
-                best_action = mov
-                break
-            if score >= best_score:
-                best_score = score
-                best_action = mov
+                edge = self.select_action_q_and_u(node, len(history) == 1)  # history: [root key] at the root
+                if edge is None:  # every move of the root is forbidden (no_act): lost for the side to move
+                    return FINISHED, -1
+
+                tree.sum_n[node] += 1
+                tree.n[edge] += virtual_loss
+                tree.w[edge] -= virtual_loss
+                tree.q[edge] = tree.w[edge] / tree.n[edge]
 
-        if best_action == None:
-            logger.error(f"Best action is None, legal_moves = {legal_moves}, best_score = {best_score}")
-        # if is_root_node:
-        #     logger.debug(f"selected action = {best_action}, with U + Q = {best_score}")
-        return best_action
+                history.append(edge)
+                state.push(int(tree.move[edge]))
+                history.append(state.key)
 
-    def expand_and_evaluate(self, state, history, real_hist=None):
+    def select_action_q_and_u(self, node, is_root_node):
         '''
-        Evaluate the state, return its policy and value computed by neural network
+        Select the edge with highest Q(s,a) + U(s,a), None if every move of the root is in no_act
         '''
-        if self.use_history:
-            if real_hist:
-                # logger.debug(f"real history = {real_hist}")
-                state_planes = senv.state_history_to_planes(state, real_hist)
-            else:
-                # logger.debug(f"history = {history}")
-                state_planes = senv.state_history_to_planes(state, history)
-        else:
-            state_planes = senv.state_to_planes(state)
-        with self.q_lock:
-            self.buffer_planes.append(state_planes)
+        tree = self.tree
+        edges = tree.edges(node)
+        n, q, p = tree.n[edges], tree.q[edges], tree.p[edges].astype(np.float64)
+
+        if is_root_node and self.noise_eps:
+            if self.root_noise is None:  # one dirichlet draw per search
+                self.root_noise = np.random.dirichlet(self.play_config.dirichlet_alpha * np.ones(len(p)))
+            e = self.noise_eps
+            p = (1 - e) * p + e * self.root_noise
+        # Q + U, U = c_puct * P * sqrt(sum(N(s, b); for all b)) / (1 + N(s, a))
+        score = q + self.play_config.c_puct * p * np.sqrt(int(tree.sum_n[node]) + 1) / (1 + n)
+        win = q > (1 - 1e-7)
+        if is_root_node and self.no_act:
+            blocked = np.isin(tree.move[edges], self.no_act)
+            score[blocked] = -np.inf
+            win &= ~blocked
+            if blocked.all():
+                return None
+        if win.any():
+            return edges.start + int(np.argmax(win))
+        # the last of the best scores
+        return edges.stop - 1 - int(np.argmax(score[::-1]))
+
+    def last_state(self, history):
+        '''
+        The state of the same side one move before the end of `history` for the history planes:
+        zobrist key of an ancestor in the tree, position of the real game before the root or None
+        '''
+        if not self.use_history:
+            return None
+        if len(history) >= 5:
+            return history[-5]  # zobrist key of the ancestor, its planes are cached
+        if self.real_hist and len(self.real_hist) >= 6 - len(history):
+            return self.real_hist[len(history) - 6]
+        return None
+
+    def expand_and_evaluate(self, state, history):
+        '''
+        Queue the state for the neural network, its policy and value are backed up by update_tree
+        '''
+        last_state = self.last_state(history)
+        ret = self.lookup(state, last_state)
+        if ret is not None:
+            self.update_tree(ret[0], ret[1], history)
+            return
+        # planes are encoded by the sender, a batch at a time
+        with self.q_cond:
+            self.buffer_states.append(state)
+            self.buffer_lasts.append(last_state)
             self.buffer_history.append(history)
             # logger.debug(f"EAE append buffer_history history = {history}")
+            pending = len(self.buffer_states) - self.sent
+            if pending == 1:
+                self.flush_time = time() + self.play_config.flush_timeout_us * 1e-6
+            if pending == 1 or pending == self.flush_leaves:
+                self.q_cond.notify_all()
 
-    def update_tree(self, p, v, history):
-        state = history.pop()
-        z = v
-
-        if p is not None:
-            with self.node_lock[state]:
+    def update_tree(self, p, v, history, leaf=None):
+        '''
+        Back up a search, `leaf`: (position, last state, model generation) of a NN result to cache
+        '''
+        with self.tree_lock:
+            if p is not None:
                 # logger.debug(f"return from NN state = {state}, v = {v}")
-                node = self.tree[state]
-                node.p = p
-                node.waiting = False
-                if self.debugging:
-                    self.debug[state] = (p, v)
-                for hist in node.visit:
+                for state, hist in self.set_prediction(history[-1], p, v):
                     self.executor.submit(self.MCTS_search, state, hist)
-                node.visit = []
-
-        virtual_loss = self.config.play.virtual_loss
-        # logger.debug(f"backup from {state}, v = {v}, history = {history}")
-        while len(history) > 0:
-            action = history.pop()
-            state = history.pop()
-            v = - v
-            with self.node_lock[state]:
-                node = self.tree[state]
-                action_state = node.a[action]
-                action_state.n += 1 - virtual_loss
-                action_state.w += v + virtual_loss
-                action_state.q = action_state.w * 1.0 / action_state.n
-                # logger.debug(f"update value: state = {state}, action = {action}, n = {action_state.n}, w = {action_state.w}, q = {action_state.q}")
+                if leaf is not None:
+                    self.cache_prediction(leaf[0], leaf[1], v, leaf[2])
+            self.backup(v, history)
 
         with self.t_lock:
             self.num_task -= 1
@@ -372,24 +884,93 @@ class CChessPlayer:
             if self.num_task <= 0:
                 self.all_done.release()
 
-    def calc_policy(self, state, turns, no_act) -> np.ndarray:
+    def set_prediction(self, key, p, v):
+        '''
+        Store the NN policy of the node `key`, return the searches that were waiting for it
+        '''
+        node = self.tree.get(key)
+        self.tree.set_prior(node, p)
+        if self.debugging:
+            self.debug[key] = (p, v)
+        return self.tree.visit.pop(node, [])
+
+    def cache_key(self, state, last):
+        if not self.use_history or last is None:
+            return state.key, None
+        return state.key, last if isinstance(last, int) else last.key
+
+    def table_keys(self, states, lasts):
+        return [table_key(*self.cache_key(state, last)) for state, last in zip(states, lasts)]
+
+    def lookup(self, state, last):
+        '''
+        NN result (policy, value) of the leaf `state` from eval_cache or from the shared eval_table,
+        None on a miss
+        '''
+        key = self.cache_key(state, last)
+        if self.eval_cache is not None:
+            ret = self.eval_cache.get(key)
+            if ret is not None:
+                (moves, priors), v = ret
+                policy = np.zeros(self.labels_n, dtype=np.float32)
+                policy[moves] = priors  # by move id, the edge order differs between RED and BLACK
+                return policy, v
+        if self.eval_table is not None:
+            ret = self.eval_table.get(table_key(*key))
+            if ret is not None:
+                return ret
+        return None
+
+    def cache_prediction(self, state, last, v, generation):
+        '''
+        Cache the NN result of the leaf `state`, once set_prediction pushed its policy to the edges
+        '''
+        if self.eval_cache is not None:
+            priors = self.tree.priors(self.tree.get(state.key))
+            self.eval_cache.put(self.cache_key(state, last), (priors, v), generation)
+
+    def backup(self, v, history):
+        '''
+        Back up the value v of the last position of history ([key, edge, ..., key]) and remove the virtual loss
+        '''
+        tree = self.tree
+        virtual_loss = self.config.play.virtual_loss
+        history.pop()
+        # logger.debug(f"backup v = {v}, history = {history}")
+        while len(history) > 0:
+            edge = history.pop()
+            history.pop()
+            v = - v
+            tree.n[edge] += 1 - virtual_loss
+            tree.w[edge] += v + virtual_loss
+            tree.q[edge] = tree.w[edge] / tree.n[edge]
+
+    def calc_policy(self, key, turns, no_act) -> np.ndarray:
         '''
         calculate π(a|s0) according to the visit count
         '''
-        node = self.tree[state]
+        tree = self.tree
         policy = np.zeros(self.labels_n)
         max_q_value = -100
         debug_result = {}
 
-        for mov, action_state in node.a.items():
-            policy[self.move_lookup[mov]] = action_state.n
-            if no_act and mov in no_act:
-                policy[self.move_lookup[mov]] = 0
-                continue
+        with self.tree_lock:
+            edges = tree.edges(tree.get(key))
+            moves = tree.move[edges].astype(np.intp)
+            n, q, p = tree.n[edges], tree.q[edges], tree.p[edges]
+            policy[moves] = n
+            allowed = np.ones(len(moves), dtype=np.bool_)
+            if no_act:
+                allowed = ~np.isin(moves, no_act)
+                policy[moves[~allowed]] = 0
+            if not allowed.any():  # every move is forbidden: lost
+                logger.error(f"Best action is None, legal_moves = {moves}, no_act = {no_act}")
+                return policy, True
+            max_q_value = max(max_q_value, q[allowed].max())
             if self.debugging:
-                debug_result[mov] = (action_state.n, action_state.q, action_state.p)
-            if action_state.q > max_q_value:
-                max_q_value = action_state.q
+                for mov, n_, q_, p_ in zip(moves[allowed].tolist(), n[allowed].tolist(), q[allowed].tolist(),
+                                           p[allowed].tolist()):
+                    debug_result[mov] = (n_, q_, p_)
 
         if max_q_value < self.play_config.resign_threshold and self.enable_resign and turns > self.play_config.min_resign_turn:
             return policy, True
@@ -398,9 +979,8 @@ class CChessPlayer:
             temp = sorted(range(len(policy)), key=lambda k: policy[k], reverse=True)
             for i in range(5):
                 index = temp[i]
-                mov = ActionLabelsRed[index]
-                if mov in debug_result:
-                    self.search_results[mov] = debug_result[mov]
+                if index in debug_result:
+                    self.search_results[ActionLabelsRed[index]] = debug_result[index]
 
         policy /= np.sum(policy)
         return policy, False
@@ -415,26 +995,30 @@ class CChessPlayer:
             value = -value
         score = int(value * 1000)
         output = f"info depth {depth} score {score} time {int((end_time - start_time) * 1000)} pv"
+        state = state.copy()
         i = 0
+        tree = self.tree
         while i < 10:
-            node = self.tree[state]
+            node = tree.get(state.key)
             bestmove = None
             root = True
             n = 0
-            if len(node.a) == 0:
+            if node is None or tree.count[node] == 0:
                 break
-            for mov, action_state in node.a.items():
-                if action_state.n >= n:
+            edges = tree.edges(node)
+            for mov, n_ in zip(tree.move[edges].tolist(), tree.n[edges].tolist()):
+                if n_ >= n:
                     if root and no_act and mov in no_act:
                         continue
-                    n = action_state.n
+                    n = n_
                     bestmove = mov
             if bestmove is None:
                 logger.error(
-                    f"state = {state}, turns = {turns}, no_act = {no_act}, root = {root}, len(as) = {len(node.a)}")
+                    f"state = {state}, turns = {turns}, no_act = {no_act}, root = {root}, len(as) = {tree.count[node]}")
                 break
-            state = senv.step(state, bestmove)
+            state.push(bestmove)
             root = False
+            bestmove = ActionLabelsRed[bestmove]
             if turns % 2 == 1:
                 bestmove = flip_move(bestmove)
             bestmove = senv.to_uci_move(bestmove)
@@ -445,7 +1029,7 @@ class CChessPlayer:
         logger.debug(output)
         sys.stdout.flush()
 
-    def apply_temperature(self, policy, turn) -> np.ndarray:
+    def temperature(self, turn):
         if turn < 30 and self.play_config.tau_decay_rate != 0:
             tau = tau = np.power(self.play_config.tau_decay_rate, turn + 1)
         else:
@@ -454,6 +1038,10 @@ class CChessPlayer:
             tau = 0
         if self.increase_temp and not self.config.opts.evaluate:
             tau = 1
+        return tau
+
+    def apply_temperature(self, policy, turn) -> np.ndarray:
+        tau = self.temperature(turn)
         if tau == 0:
             action = np.argmax(policy)
             ret = np.zeros(self.labels_n)
@@ -122,6 +122,24 @@ class CChessModel:
             self.api.start(need_reload)
         return self.api.get_pipe(need_reload)
 
+    def get_eval_table(self, slots):
+        '''
+        Name of the shared memory table of the prediction results (see SharedEvalTable) of the API
+        started by get_pipes, None if disabled
+        '''
+        if self.api is None:
+            return None
+        return self.api.create_table(slots)
+
+    def get_generation(self, manager):
+        '''
+        Model generation of the API started by get_pipes as a manager Value (see EvalCache.sync),
+        None if not started
+        '''
+        if self.api is None:
+            return None
+        return self.api.share_generation(manager)
+
     def close_pipes(self):
         if self.api is not None:
             self.api.close()
@@ -0,0 +1,101 @@
+'''
+Benchmark of the PUCT selection, selections per second of the per-move loop that was used before
+(one dirichlet draw per legal move) and of the vectorised CChessPlayer.select_action_q_and_u.
+
+    python -m src.agent.select_benchmark [--seconds 2] [--visits 800]
+'''
+import argparse
+import random
+from time import time
+
+import numpy as np
+
+import src.environment.light.static_env as senv
+from src.agent.mcts import CChessPlayer
+from src.config import Config
+
+
+def random_state(plies, seed=0):
+    rng = random.Random(seed)
+    state = senv.INIT_STATE
+    for _ in range(plies):
+        state = senv.step(state, rng.choice(senv.get_legal_moves(state)))
+    return state
+
+
+def loop_select(player, node, is_root_node):
+    '''
+    The selection before vectorisation: a python loop over the legal moves
+    '''
+    tree = player.tree
+    edges = tree.edges(node)
+    legal_moves = tree.move[edges].tolist()
+    n, q, p = tree.n[edges].tolist(), tree.q[edges].tolist(), tree.p[edges].tolist()
+    xx_ = np.sqrt(int(tree.sum_n[node]) + 1)
+    e = player.play_config.noise_eps
+    c_puct = player.play_config.c_puct
+    dir_alpha = player.play_config.dirichlet_alpha
+    best_score = -99999999
+    best_action = None
+    for i, mov in enumerate(legal_moves):
+        p_ = p[i]
+        if is_root_node:
+            p_ = (1 - e) * p_ + e * np.random.dirichlet(dir_alpha * np.ones(len(legal_moves)))[0]
+        score = q[i] + c_puct * p_ * xx_ / (1 + n[i])
+        if q[i] > (1 - 1e-7):
+            return edges.start + i
+        if score >= best_score:
+            best_score = score
+            best_action = i
+    return edges.start + best_action
+
+
+def make_player(state, visits, seed=0):
+    '''
+    A player whose tree holds the expanded `state` with random priors and `visits` random visits
+    '''
+    rng = np.random.RandomState(seed)
+    player = CChessPlayer(Config(config_type='mini'))
+    player.job_done = True  # no network behind, stop the sender / receiver
+    pos = senv.new_position(state)
+    node = player.tree.add(pos.key, pos.get_legal_moves())
+    edges = player.tree.edges(node)
+    player.tree.set_prior(node, rng.dirichlet(np.ones(player.labels_n)))
+    count = edges.stop - edges.start
+    n = rng.multinomial(visits, np.ones(count) / count)
+    player.tree.n[edges] = n
+    player.tree.w[edges] = n * rng.uniform(-1, 1, count)
+    player.tree.q[edges] = player.tree.w[edges] / np.maximum(n, 1)
+    player.tree.sum_n[node] = visits + 1
+    player.root_key = pos.key
+    return player, node
+
+
+def rate(select, player, node, is_root_node, seconds):
+    count = 0
+    start = time()
+    while time() - start < seconds:
+        for _ in range(100):
+            select(player, node, is_root_node)
+        count += 100
+    return count / (time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", help="time of every measure", default=2, type=float)
+    parser.add_argument("--visits", help="visits of the benchmarked node", default=800, type=int)
+    args = parser.parse_args()
+    vectorised = CChessPlayer.select_action_q_and_u
+    for name, state in (('opening', senv.INIT_STATE), ('midgame', random_state(40))):
+        player, node = make_player(state, args.visits)
+        for is_root_node in (True, False):
+            before = rate(loop_select, player, node, is_root_node, args.seconds)
+            after = rate(vectorised, player, node, is_root_node, args.seconds)
+            print(f"{name} {'root' if is_root_node else 'inner'} ({player.tree.count[node]} moves): "
+                  f"loop {before:.0f}/s, vectorised {after:.0f}/s, x{after / before:.1f}")
+        player.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -67,6 +67,7 @@ class Options:
     gpu_num = 1
     evaluate = False
     has_history = True
+    env_backend = 'board'  # move generation of the light environment: board / bitboard
 
 
 class PlayWithHumanConfig:
@@ -35,6 +35,19 @@ class PlayConfig:
     def __init__(self):
         self.max_processes = 10
         self.search_threads = 40
+        self.search_driver = 'threads'  # 'threads', or 'batched': one thread evaluating search_threads leaves per request
+        self.flush_leaves = self.search_threads  # send a prediction request once this many leaves are pending (at most search_threads)
+        self.flush_timeout_us = 1000  # or once the oldest pending leaf has waited this long
+        self.parallel_games = 1  # self-play games per process in lock-step, their leaves share one prediction request
+        self.move_time = 0  # seconds of search per move on top of the simulations budget, 0: none
+        self.early_stop = False  # stop once the most visited move cannot be overtaken (greedy moves only), self-play turns it on
+        self.full_search_prob = 1  # self-play: probability of a full search, recorded as a training target
+        self.fast_search_num = 100  # self-play: simulations of the other moves (no noise, not a training target)
+        self.kl_adaptive = False  # search until the root visits converge instead of simulation_num_per_move
+        self.kl_interval = 100  # simulations between two snapshots of the root visit distribution
+        self.kl_threshold = 5e-6  # stop once the KL divergence of two snapshots per simulation is below it
+        self.kl_min_simulations = 200
+        self.kl_max_simulations = 1600
         self.vram_frac = 1.0
         self.simulation_num_per_move = 800
         self.thinking_loop = 1
@@ -46,6 +59,11 @@ class PlayConfig:
         self.virtual_loss = 3
         self.resign_threshold = -0.98
         self.min_resign_turn = 40
+        self.max_plane_cache = 200000  # max positions whose encoded planes are cached by the MCTS
+        self.eval_cache_size = 100000  # NN results kept per self-play process (LRU), emptied on a model reload
+        self.shared_cache_slots = 0  # slots of the NN results table shared by the self-play processes (4.2 KB of /dev/shm each), 0: off
+        self.max_nodes = 1000000  # search tree capacity, least visited nodes are evicted beyond it
+        self.max_bytes = 1 << 30  # search tree memory limit
         self.enable_resign_rate = 0.5
         self.max_game_length = 100
         self.share_mtcs_info_in_self_play = False
@@ -73,6 +91,7 @@ class TrainerConfig:
         ]
         self.sl_game_step = 2000
         self.load_step = 6
+        self.mirror_augmentation = False  # also train on the left-right mirror of every position
 
 
 class ModelConfig:
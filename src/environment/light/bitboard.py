@@ -0,0 +1,238 @@
+from src.environment.light.common import RED, BLACK
+from src.environment.light.move_tables import BOARD_HEIGHT, BOARD_WIDTH, BOARD_SIZE, KNIGHT_MOVES, ELEPHANT_MOVES, \
+    MANDARIN_MOVES, OWN_HALF, KING_MOVES, PAWN_MOVES, KNIGHT_ATTACKS, PAWN_ATTACKS
+from src.environment.light.position import Position, _SQUARES_ID, PAWN, CANNON, ROOK, KNIGHT, ELEPHANT, MANDARIN, KING
+
+# Bitboard backend of the light environment.
+# A bitboard is a 90-bit python int, bit sq set <=> square sq (= y * 9 + x) is occupied.
+# Rook and cannon moves are looked up by the occupancy of their rank (9 bits) and file
+# (10 bits). File occupancy is read from a rotated bitboard whose bit x * 10 + y is square (x, y).
+
+RANK_MASK = (1 << BOARD_WIDTH) - 1
+FILE_MASK = (1 << BOARD_HEIGHT) - 1
+SQ_BIT = [1 << sq for sq in range(BOARD_SIZE)]
+SQ_X = [sq % BOARD_WIDTH for sq in range(BOARD_SIZE)]
+SQ_Y = [sq // BOARD_WIDTH for sq in range(BOARD_SIZE)]
+RANK_SHIFT = [y * BOARD_WIDTH for y in SQ_Y]  # bitboard >> RANK_SHIFT[sq] & RANK_MASK: occupancy of sq's rank
+FILE_SHIFT = [x * BOARD_HEIGHT for x in SQ_X]  # rotated >> FILE_SHIFT[sq] & FILE_MASK: occupancy of sq's file
+ROT_BIT = [1 << ((sq % BOARD_WIDTH) * BOARD_HEIGHT + sq // BOARD_WIDTH) for sq in range(BOARD_SIZE)]
+
+
+def _line_tables(length):
+    '''
+    For a line of `length` squares: rook[i][occ] is the mask of squares a rook on i reaches
+    (first blocker included), jump[i][occ] the mask of squares a cannon on i captures
+    '''
+    rook = [[0] * (1 << length) for _ in range(length)]
+    jump = [[0] * (1 << length) for _ in range(length)]
+    for i in range(length):
+        for occ in range(1 << length):
+            for step in (-1, 1):
+                j = i + step
+                screen = False
+                while 0 <= j < length:
+                    occupied = occ >> j & 1
+                    if not screen:
+                        rook[i][occ] |= 1 << j
+                        if occupied:
+                            screen = True
+                    elif occupied:
+                        jump[i][occ] |= 1 << j
+                        break
+                    j += step
+    return rook, jump
+
+
+def _spread_file(mask):
+    '''
+    10-bit file mask -> bitboard of file 0
+    '''
+    bb = 0
+    for y in range(BOARD_HEIGHT):
+        if mask >> y & 1:
+            bb |= SQ_BIT[y * BOARD_WIDTH]
+    return bb
+
+
+def _to_mask(squares):
+    mask = 0
+    for sq in squares:
+        mask |= SQ_BIT[sq]
+    return mask
+
+
+def _group_by_block(moves):
+    '''
+    [(to, block)] -> [(block bit, mask of the destinations behind that block)]
+    '''
+    groups = {}
+    for to, block in moves:
+        groups[block] = groups.get(block, 0) | SQ_BIT[to]
+    return [(SQ_BIT[block], mask) for block, mask in groups.items()]
+
+
+RANK_ROOK, RANK_JUMP = _line_tables(BOARD_WIDTH)
+FILE_ROOK, FILE_JUMP = _line_tables(BOARD_HEIGHT)
+FILE_SPREAD = [_spread_file(mask) for mask in range(1 << BOARD_HEIGHT)]
+
+KING_MASK = [[_to_mask(KING_MOVES[color][sq]) for sq in range(BOARD_SIZE)] for color in (BLACK, RED)]
+MANDARIN_MASK = [[_to_mask(MANDARIN_MOVES[color][sq]) for sq in range(BOARD_SIZE)] for color in (BLACK, RED)]
+PAWN_MASK = [[_to_mask(PAWN_MOVES[color][sq]) for sq in range(BOARD_SIZE)] for color in (BLACK, RED)]
+KNIGHT_BY_LEG = [_group_by_block(KNIGHT_MOVES[sq]) for sq in range(BOARD_SIZE)]
+ELEPHANT_BY_EYE = [[_group_by_block(ELEPHANT_MOVES[color][sq]) for sq in range(BOARD_SIZE)] for color in (BLACK, RED)]
+
+
+# KNIGHT_ATTACKERS[sq]: [(leg bit, mask of knight squares that reach sq through that leg)]
+KNIGHT_ATTACKERS = [_group_by_block(KNIGHT_ATTACKS[sq]) for sq in range(BOARD_SIZE)]
+PAWN_ATTACKERS = [[_to_mask(PAWN_ATTACKS[color][sq]) for sq in range(BOARD_SIZE)] for color in (BLACK, RED)]
+
+
+def iter_bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class BitboardPosition(Position):
+    '''
+    Position that also keeps bitboards per side and piece kind, updated on every push / pop.
+    Move generation and attack detection run on the bitboards.
+    '''
+    __slots__ = ('bitboards', 'occ', 'rot')
+
+    def __init__(self):
+        super().__init__()
+        self.bitboards = [[0] * 8, [0] * 8]  # indexed by color, piece kind
+        self.occ = [0, 0]  # indexed by color
+        self.rot = 0  # rotated occupancy of both sides
+
+    def put(self, sq, code):
+        super().put(sq, code)
+        color = RED if code > 0 else BLACK
+        self.bitboards[color][code if code > 0 else -code] |= SQ_BIT[sq]
+        self.occ[color] |= SQ_BIT[sq]
+        self.rot |= ROT_BIT[sq]
+
+    def copy(self):
+        pos = super().copy()
+        pos.bitboards = [list(self.bitboards[0]), list(self.bitboards[1])]
+        pos.occ = list(self.occ)
+        pos.rot = self.rot
+        return pos
+
+    def _toggle(self, fr, to, code, captured, me):
+        move = SQ_BIT[fr] | SQ_BIT[to]
+        self.bitboards[me][code if code > 0 else -code] ^= move
+        self.occ[me] ^= move
+        self.rot ^= ROT_BIT[fr]
+        if captured:
+            self.bitboards[1 - me][captured if captured > 0 else -captured] ^= SQ_BIT[to]
+            self.occ[1 - me] ^= SQ_BIT[to]
+        else:
+            self.rot ^= ROT_BIT[to]
+
+    def _apply(self, fr, to):
+        code = self.board[fr]
+        captured = super()._apply(fr, to)
+        self._toggle(fr, to, code, captured, 1 - self.turn)
+        return captured
+
+    def pop(self):
+        fr, to, captured = self.undo[-1][:3]
+        code = self.board[to]
+        move = super().pop()
+        self._toggle(fr, to, code, captured, self.turn)
+        return move
+
+    def _rank_file(self, sq, rank_table, file_table):
+        x, y = SQ_X[sq], SQ_Y[sq]
+        rank = rank_table[x][((self.occ[0] | self.occ[1]) >> RANK_SHIFT[sq]) & RANK_MASK] << RANK_SHIFT[sq]
+        file = FILE_SPREAD[file_table[y][(self.rot >> FILE_SHIFT[sq]) & FILE_MASK]] << x
+        return rank, file
+
+    def destinations(self, sq, code, color):
+        '''
+        Bitboard of the pseudo-legal destinations of the piece `code` of `color` on `sq`
+        '''
+        kind = code if code > 0 else -code
+        own = self.occ[color]
+        if kind == PAWN:
+            return PAWN_MASK[color][sq] & ~own
+        if kind == MANDARIN:
+            return MANDARIN_MASK[color][sq] & ~own
+        other = self.occ[1 - color]
+        occ = own | other
+        if kind == KNIGHT or kind == ELEPHANT:
+            mask = 0
+            for block, dests in (KNIGHT_BY_LEG[sq] if kind == KNIGHT else ELEPHANT_BY_EYE[color][sq]):
+                if not occ & block:
+                    mask |= dests
+            return mask & ~own
+        x, y, shift = SQ_X[sq], SQ_Y[sq], RANK_SHIFT[sq]
+        rank_occ = (occ >> shift) & RANK_MASK
+        file_occ = (self.rot >> FILE_SHIFT[sq]) & FILE_MASK
+        if kind == ROOK:
+            return ((RANK_ROOK[x][rank_occ] << shift) | (FILE_SPREAD[FILE_ROOK[y][file_occ]] << x)) & ~own
+        if kind == CANNON:
+            slide = (RANK_ROOK[x][rank_occ] << shift) | (FILE_SPREAD[FILE_ROOK[y][file_occ]] << x)
+            jump = (RANK_JUMP[x][rank_occ] << shift) | (FILE_SPREAD[FILE_JUMP[y][file_occ]] << x)
+            return (slide & ~occ) | (jump & other)
+        # flying king: capture the opponent king on an open file
+        file = FILE_SPREAD[FILE_ROOK[y][file_occ]] << x
+        return (KING_MASK[color][sq] & ~own) | (file & self.bitboards[1 - color][KING])
+
+    def _targets(self, sq, code, color):
+        return list(iter_bits(self.destinations(sq, code, color)))
+
+    def get_legal_moves(self):
+        turn = self.turn
+        board = self.board
+        ids = _SQUARES_ID[turn]
+        destinations = self.destinations
+        legal_moves = []
+        for sq in sorted(self.pieces[turn], reverse=turn == BLACK):
+            base = sq * BOARD_SIZE
+            mask = destinations(sq, board[sq], turn)
+            while mask:
+                low = mask & -mask
+                legal_moves.append(ids[base + low.bit_length() - 1])
+                mask ^= low
+        return legal_moves
+
+    def attackers(self, sq, by):
+        '''
+        Bitboard of the pieces of `by` that could capture a piece standing on `sq`
+        (the colour of that piece is ignored: own pieces count as defended)
+        '''
+        bbs = self.bitboards[by]
+        occ = self.occ[0] | self.occ[1]
+        rank, file = self._rank_file(sq, RANK_ROOK, FILE_ROOK)
+        mask = (rank | file) & bbs[ROOK]
+        if sq == self.kings[1 - by]:
+            mask |= file & bbs[KING]
+        if bbs[CANNON]:
+            jump_rank, jump_file = self._rank_file(sq, RANK_JUMP, FILE_JUMP)
+            mask |= (jump_rank | jump_file) & bbs[CANNON]
+        if bbs[KNIGHT]:
+            for leg, knights in KNIGHT_ATTACKERS[sq]:
+                if not occ & leg:
+                    mask |= knights & bbs[KNIGHT]
+        mask |= PAWN_ATTACKERS[by][sq] & bbs[PAWN]
+        mask |= KING_MASK[by][sq] & bbs[KING]
+        mask |= MANDARIN_MASK[by][sq] & bbs[MANDARIN]
+        if bbs[ELEPHANT] and OWN_HALF[by][sq]:
+            for eye, dest in ELEPHANT_BY_EYE[by][sq]:
+                if not occ & eye:
+                    mask |= dest & bbs[ELEPHANT]
+        return mask
+
+    def attacker(self, sq, by):
+        mask = self.attackers(sq, by)
+        return (mask & -mask).bit_length() - 1
+
+    def attacker_squares(self, sq, by):
+        return list(iter_bits(self.attackers(sq, by)))
+
+    def is_attacked(self, sq, by):
+        return self.attackers(sq, by) != 0
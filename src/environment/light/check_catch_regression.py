@@ -0,0 +1,82 @@
+'''
+Regression check of static_env.will_check_or_catch against the move-generation reference
+will_check_or_catch_by_moves, over recorded self-play games and random games.
+
+    python -m src.environment.light.check_catch_regression [--type mini] [--games 20] [--random 20]
+
+Every legal move of every position of a game is compared, the answers must be identical.
+'''
+import argparse
+import random
+from logging import getLogger
+
+import src.environment.light.static_env as senv
+from src.utils.data_helper import get_game_data_filenames, read_game_data_from_file
+
+logger = getLogger(__name__)
+
+
+def compare_state(state):
+    '''
+    return (number of compared moves, [mismatching moves])
+    '''
+    moves = senv.get_legal_moves(state)
+    mismatches = [action for action in moves
+                  if senv.will_check_or_catch(state, action) != senv.will_check_or_catch_by_moves(state, action)]
+    return len(moves), mismatches
+
+
+def recorded_games(config, max_games):
+    for filename in get_game_data_filenames(config.resource)[:max_games]:
+        data = read_game_data_from_file(filename)
+        yield filename, data[0], [item[0] for item in data[1:]]
+
+
+def random_games(num, max_length=200, seed=0):
+    rng = random.Random(seed)
+    for idx in range(num):
+        state = senv.INIT_STATE
+        actions = []
+        for _ in range(max_length):
+            moves = senv.get_legal_moves(state)
+            if not moves or senv.done(state)[0]:
+                break
+            actions.append(rng.choice(moves))
+            state = senv.step(state, actions[-1])
+        yield f"random game {idx}", senv.INIT_STATE, actions
+
+
+def run(games):
+    total, failed = 0, 0
+    for name, state, actions in games:
+        for action in [None] + actions:
+            if action is not None:
+                state = senv.step(state, action)
+            if senv.done(state)[0]:
+                break
+            n, mismatches = compare_state(state)
+            total += n
+            for mov in mismatches:
+                failed += 1
+                logger.error(f"{name}: will_check_or_catch mismatch, state = {state}, action = {mov}")
+                print(f"{name}: mismatch, state = {state}, action = {mov}")
+    print(f"compared {total} moves, {failed} mismatches")
+    return failed == 0
+
+
+def main():
+    from src.config import Config
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--type", help="config type of the play data dir", default="mini")
+    parser.add_argument("--games", help="max recorded games to replay", default=20, type=int)
+    parser.add_argument("--random", help="random games to play", default=20, type=int)
+    parser.add_argument("--seed", help="seed of the random games", default=0, type=int)
+    args = parser.parse_args()
+    config = Config(config_type=args.type)
+    ok = run(recorded_games(config, args.games))
+    ok = run(random_games(args.random, seed=args.seed)) and ok
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -39,6 +39,13 @@ def flip_move(x):
     return new
 
 
+def mirror_move(x):
+    '''
+    left-right mirror (file a <-> i) of a move string
+    '''
+    return ''.join([str(8 - int(x[0])), x[1], str(8 - int(x[2])), x[3]])
+
+
 def flip_action_labels(labels):
     return [flip_move(x) for x in labels]
 
@@ -119,9 +126,53 @@ def create_action_labels():
 ActionLabelsRed = create_action_labels()
 ActionLabelsBlack = flip_action_labels(ActionLabelsRed)
 
-Unflipped_index = [ActionLabelsRed.index(x) for x in ActionLabelsBlack]
+# integer move ids: the id of a move string is its index in ActionLabelsRed (the policy index)
+Move_Ids = {move: i for i, move in enumerate(ActionLabelsRed)}
+# from / to square (y * 9 + x, in the frame of the side to move) of every move id
+Move_From = np.asarray([int(move[1]) * 9 + int(move[0]) for move in ActionLabelsRed], dtype=np.int16)
+Move_To = np.asarray([int(move[3]) * 9 + int(move[2]) for move in ActionLabelsRed], dtype=np.int16)
+
+# Policy permutations: transformed_policy = policy[..., perm], every one is its own inverse.
+# colour flip: the policy of the same position seen by the other side
+Move_Flip = np.asarray([Move_Ids[move] for move in ActionLabelsBlack], dtype=np.intp)
+# left-right mirror
+Move_Mirror = np.asarray([Move_Ids[mirror_move(move)] for move in ActionLabelsRed], dtype=np.intp)
+# colour flip and left-right mirror together
+Move_Flip_Mirror = Move_Mirror[Move_Flip]
+
+Unflipped_index = [int(i) for i in Move_Flip]
+
+
+def move_to_id(move):
+    '''
+    move string (or move id) -> move id
+    '''
+    return Move_Ids[move] if isinstance(move, str) else int(move)
+
+
+def id_to_move(move):
+    '''
+    move id (or move string) -> move string
+    '''
+    return move if isinstance(move, str) else ActionLabelsRed[move]
 
 
 def flip_policy(pol):
-    global Unflipped_index
-    return np.asarray([pol[ind] for ind in Unflipped_index])
+    '''
+    colour flip of a policy vector, or of every row of an (N, 2086) policy array
+    '''
+    return np.asarray(pol)[..., Move_Flip]
+
+
+def mirror_policy(pol):
+    '''
+    left-right mirror of a policy vector, or of every row of an (N, 2086) policy array
+    '''
+    return np.asarray(pol)[..., Move_Mirror]
+
+
+def flip_mirror_policy(pol):
+    '''
+    colour flip of the left-right mirror of a policy vector or an (N, 2086) policy array
+    '''
+    return np.asarray(pol)[..., Move_Flip_Mirror]
@@ -0,0 +1,145 @@
+from src.environment.light.common import RED, BLACK
+
+# Precomputed move-generation tables, built once at import time.
+# Squares are absolute: square = y * 9 + x, red starts on rows 0 ~ 4. The board of
+# static_env is always seen from the side to move, so it uses the RED tables.
+# Tables that depend on the side are indexed by color first: TABLE[color][square].
+
+BOARD_HEIGHT = 10
+BOARD_WIDTH = 9
+BOARD_SIZE = BOARD_HEIGHT * BOARD_WIDTH
+
+# 'xy' string of every square, a move string is SQUARE_STR[from] + SQUARE_STR[to]
+SQUARE_STR = [f"{sq % BOARD_WIDTH}{sq // BOARD_WIDTH}" for sq in range(BOARD_SIZE)]
+
+# ray directions, RAYS[sq][i] follows RAY_DIRECTIONS[i]
+DOWN, RIGHT, UP, LEFT = 0, 1, 2, 3
+RAY_DIRECTIONS = [(0, -1), (1, 0), (0, 1), (-1, 0)]
+_DIAGONAL = [(-1, -1), (1, -1), (-1, 1), (1, 1)]
+_ELEPHANT = [(-2, -2), (2, -2), (2, 2), (-2, 2)]
+_KNIGHT = [(-1, -2), (1, -2), (2, -1), (2, 1), (1, 2), (-1, 2), (-2, 1), (-2, -1)]
+
+
+def _on_board(x, y):
+    return 0 <= x < BOARD_WIDTH and 0 <= y < BOARD_HEIGHT
+
+
+def _relative_row(y, color):
+    return y if color == RED else BOARD_HEIGHT - 1 - y
+
+
+def _build_masks():
+    palace, own_half = [None, None], [None, None]
+    for color in (BLACK, RED):
+        palace[color] = [3 <= sq % BOARD_WIDTH <= 5 and _relative_row(sq // BOARD_WIDTH, color) <= 2
+                         for sq in range(BOARD_SIZE)]
+        own_half[color] = [_relative_row(sq // BOARD_WIDTH, color) <= 4 for sq in range(BOARD_SIZE)]
+    return palace, own_half
+
+
+# IN_PALACE[color][sq]: sq is inside the palace of color
+# OWN_HALF[color][sq]: sq is on color's side of the river
+IN_PALACE, OWN_HALF = _build_masks()
+
+
+def _build_rays():
+    rays = []
+    for sq in range(BOARD_SIZE):
+        x, y = sq % BOARD_WIDTH, sq // BOARD_WIDTH
+        lines = []
+        for dx, dy in RAY_DIRECTIONS:
+            line = []
+            x_, y_ = x + dx, y + dy
+            while _on_board(x_, y_):
+                line.append(y_ * BOARD_WIDTH + x_)
+                x_, y_ = x_ + dx, y_ + dy
+            lines.append(line)
+        rays.append(lines)
+    return rays
+
+
+def _build_steps(color, steps, mask):
+    table = []
+    for sq in range(BOARD_SIZE):
+        x, y = sq % BOARD_WIDTH, sq // BOARD_WIDTH
+        dests = []
+        if mask[sq]:
+            for dx, dy in steps:
+                if _on_board(x + dx, y + dy) and mask[(y + dy) * BOARD_WIDTH + x + dx]:
+                    dests.append((y + dy) * BOARD_WIDTH + x + dx)
+        table.append(dests)
+    return table
+
+
+def _build_elephant(color):
+    table = []
+    for sq in range(BOARD_SIZE):
+        x, y = sq % BOARD_WIDTH, sq // BOARD_WIDTH
+        dests = []
+        for dx, dy in _ELEPHANT:
+            x_, y_ = x + dx, y + dy
+            if _on_board(x_, y_) and OWN_HALF[color][y_ * BOARD_WIDTH + x_]:
+                eye = (y + dy // 2) * BOARD_WIDTH + x + dx // 2
+                dests.append((y_ * BOARD_WIDTH + x_, eye))
+        table.append(dests)
+    return table
+
+
+def _build_knight():
+    table = []
+    for sq in range(BOARD_SIZE):
+        x, y = sq % BOARD_WIDTH, sq // BOARD_WIDTH
+        dests = []
+        for dx, dy in _KNIGHT:
+            x_, y_ = x + dx, y + dy
+            if _on_board(x_, y_):
+                # the leg is the orthogonal step next to the knight, towards the long side
+                leg = (y + int(dy / 2)) * BOARD_WIDTH + x + int(dx / 2)
+                dests.append((y_ * BOARD_WIDTH + x_, leg))
+        table.append(dests)
+    return table
+
+
+def _build_pawn(color):
+    forward = 1 if color == RED else -1
+    table = []
+    for sq in range(BOARD_SIZE):
+        x, y = sq % BOARD_WIDTH, sq // BOARD_WIDTH
+        steps = [(0, forward)]
+        if not OWN_HALF[color][sq]:  # crossed the river
+            steps += [(-1, 0), (1, 0)]
+        table.append([(y + dy) * BOARD_WIDTH + x + dx for dx, dy in steps if _on_board(x + dx, y + dy)])
+    return table
+
+
+# RAYS[sq][direction]: squares from sq to the edge, nearest first (rook, cannon, flying king)
+RAYS = _build_rays()
+# KNIGHT_MOVES[sq]: [(to, leg)], the move is blocked if leg is occupied
+KNIGHT_MOVES = _build_knight()
+# ELEPHANT_MOVES[color][sq]: [(to, eye)], the move is blocked if eye is occupied
+ELEPHANT_MOVES = [_build_elephant(BLACK), _build_elephant(RED)]
+# MANDARIN_MOVES[color][sq], KING_MOVES[color][sq]: destinations inside the palace
+MANDARIN_MOVES = [_build_steps(BLACK, _DIAGONAL, IN_PALACE[BLACK]), _build_steps(RED, _DIAGONAL, IN_PALACE[RED])]
+KING_MOVES = [_build_steps(BLACK, RAY_DIRECTIONS, IN_PALACE[BLACK]), _build_steps(RED, RAY_DIRECTIONS, IN_PALACE[RED])]
+# PAWN_MOVES[color][sq]: forward, plus sideways once the pawn has crossed the river
+PAWN_MOVES = [_build_pawn(BLACK), _build_pawn(RED)]
+# FORWARD[color]: ray direction towards the opponent (flying king)
+FORWARD = [DOWN, UP]
+
+
+def _reverse(table):
+    reverse = [[] for _ in range(BOARD_SIZE)]
+    for sq in range(BOARD_SIZE):
+        for move in table[sq]:
+            if isinstance(move, tuple):
+                reverse[move[0]].append((sq,) + move[1:])
+            else:
+                reverse[move].append(sq)
+    return reverse
+
+
+# reverse lookups for attack detection
+# KNIGHT_ATTACKS[sq]: [(from, leg)] of the knights that reach sq, blocked if leg is occupied
+KNIGHT_ATTACKS = _reverse(KNIGHT_MOVES)
+# PAWN_ATTACKS[color][sq]: squares of the pawns of color that reach sq
+PAWN_ATTACKS = [_reverse(PAWN_MOVES[BLACK]), _reverse(PAWN_MOVES[RED])]
@@ -0,0 +1,118 @@
+import numpy as np
+
+from src.environment.light.lookup_tables import Fen_2_Idx
+from src.environment.light.move_tables import BOARD_SIZE
+from src.environment.light.position import _PLANE_OFFSET, _PLANE_OF_CODE
+
+# Batch encoder of the network input.
+# Every state is first reduced to 90 plane indices in row-major order of its state string
+# (-1 for an empty square), then all ones of the batch are written with a single fancy
+# indexing assignment. States may be static_env state strings or Position objects.
+
+# plane of every state letter, indexed by its ascii code, -1 for empty squares
+# 0 ~ 7 : upper, 7 ~ 14: lower
+_CHAR_PLANE = np.full(256, -1, dtype=np.int8)
+for _ch, _idx in Fen_2_Idx.items():
+    _CHAR_PLANE[ord(_ch)] = _idx + int(_ch.islower()) * 7
+# expand the digits of a state string to '.' and drop the row separators
+_EXPAND = str.maketrans({**{str(n): '.' * n for n in range(1, 10)}, '/': ''})
+# absolute square shown at every flat offset of a plane, indexed by the side to move
+_SQUARE_AT = np.stack([np.argsort(_PLANE_OFFSET[0]), np.argsort(_PLANE_OFFSET[1])])
+# plane indices of an unknown state
+NO_STATE = np.full(BOARD_SIZE, -1, dtype=np.int8)
+# channel permutation of the colour flip: swap the upper and lower planes of every 14-plane state
+_FLIP_CHANNELS = {channels: np.arange(channels).reshape(-1, 2, 7)[:, ::-1].ravel() for channels in (14, 28)}
+
+
+def _state_indices(states):
+    '''
+    state strings -> (N, 90) plane indices
+    '''
+    chars = ''.join([state.translate(_EXPAND) for state in states]).encode('ascii')
+    return _CHAR_PLANE[np.frombuffer(chars, dtype=np.uint8)].reshape(len(states), BOARD_SIZE)
+
+
+def _position_indices(positions):
+    '''
+    Position objects -> (N, 90) plane indices, seen from the side to move
+    '''
+    boards = np.frombuffer(b''.join([pos.board.tobytes() for pos in positions]), dtype=np.int8)
+    boards = boards.reshape(len(positions), BOARD_SIZE)
+    turns = np.fromiter((pos.turn for pos in positions), dtype=np.intp, count=len(positions))
+    codes = np.take_along_axis(boards, _SQUARE_AT[turns], axis=1).astype(np.intp)
+    codes *= (turns * 2 - 1)[:, None]  # flip the sign when black is to move
+    return _PLANE_OF_CODE[codes + 7]
+
+
+def plane_indices(states):
+    '''
+    (N, 90) plane indices of a sequence of state strings and / or Positions
+    '''
+    indices = np.empty((len(states), BOARD_SIZE), dtype=np.intp)
+    if not states:
+        return indices
+    strings = [i for i, state in enumerate(states) if isinstance(state, str)]
+    if strings:
+        indices[strings] = _state_indices([states[i] for i in strings])
+    if len(strings) < len(states):
+        others = [i for i, state in enumerate(states) if not isinstance(state, str)]
+        indices[others] = _position_indices([states[i] for i in others])
+    return indices
+
+
+def indices_to_planes(indices, last_indices=None, out=None):
+    '''
+    (N, 90) plane indices -> (N, 14, 10, 9) planes, or (N, 28, 10, 9) planes if the
+    indices of the last states are given (rows of -1 for unknown last states)
+    '''
+    n = len(indices)
+    channels = 14 if last_indices is None else 28
+    if out is None:
+        out = np.zeros(shape=(n, channels, 10, 9), dtype=np.float32)
+    else:
+        out[...] = 0
+    flat = out.reshape(n, channels, BOARD_SIZE)
+    rows, sq = np.nonzero(indices >= 0)
+    flat[rows, indices[rows, sq], sq] = 1
+    if last_indices is not None:
+        rows, sq = np.nonzero(last_indices >= 0)
+        flat[rows, last_indices[rows, sq] + 14, sq] = 1
+    return out
+
+
+def states_to_planes(states, last_states=None, out=None):
+    '''
+    Encode N states into (N, 14, 10, 9) planes, or (N, 28, 10, 9) planes if `last_states`
+    (the state of the same side one move earlier, history[-5], None if unknown) is given.
+    `out` is an optional preallocated C-contiguous float32 array of that shape, it is overwritten.
+    '''
+    indices = plane_indices(states)
+    last_indices = None
+    if last_states is not None:
+        last_indices = np.full((len(states), BOARD_SIZE), -1, dtype=np.intp)
+        rows = [i for i, last in enumerate(last_states) if last is not None]
+        if rows:
+            last_indices[rows] = plane_indices([last_states[i] for i in rows])
+    return indices_to_planes(indices, last_indices, out)
+
+
+def flip_planes(planes):
+    '''
+    Colour flip of (N, C, 10, 9) planes: the same positions seen by the other side,
+    matches lookup_tables.flip_policy
+    '''
+    return np.ascontiguousarray(planes[:, _FLIP_CHANNELS[planes.shape[1]], ::-1, ::-1])
+
+
+def mirror_planes(planes):
+    '''
+    Left-right mirror (file a <-> i) of (N, C, 10, 9) planes, matches lookup_tables.mirror_policy
+    '''
+    return np.ascontiguousarray(planes[..., ::-1])
+
+
+def flip_mirror_planes(planes):
+    '''
+    Colour flip and left-right mirror of (N, C, 10, 9) planes, matches lookup_tables.flip_mirror_policy
+    '''
+    return np.ascontiguousarray(planes[:, _FLIP_CHANNELS[planes.shape[1]], ::-1])
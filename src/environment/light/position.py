@@ -0,0 +1,488 @@
+from array import array
+from logging import getLogger
+
+import numpy as np
+
+from src.environment.light.common import RED, BLACK
+from src.environment.light.lookup_tables import Move_From, Move_To
+from src.environment.light.move_tables import BOARD_HEIGHT, BOARD_WIDTH, BOARD_SIZE, SQUARE_STR, RAYS, FORWARD, \
+    KNIGHT_MOVES, ELEPHANT_MOVES, MANDARIN_MOVES, KING_MOVES, PAWN_MOVES, OWN_HALF, KNIGHT_ATTACKS, PAWN_ATTACKS
+from src.environment.light.zobrist import PIECE_KEYS
+
+logger = getLogger(__name__)
+
+EMPTY = 0
+# piece code - 1 == Fen_2_Idx of the state letter
+PAWN, CANNON, ROOK, KNIGHT, ELEPHANT, MANDARIN, KING = 1, 2, 3, 4, 5, 6, 7
+
+# state letters of the side to move, indexed by piece code
+PIECE_CHARS = '.PCRKEMS'
+CHAR_TO_PIECE = {ch: code for code, ch in enumerate(PIECE_CHARS) if code > 0}
+
+# flat offset in a (10, 9) plane of every absolute square, when red / black is to move
+_PLANE_OFFSET = [None, None]
+_PLANE_OFFSET[RED] = np.asarray([(9 - sq // 9) * 9 + sq % 9 for sq in range(BOARD_SIZE)], dtype=np.intp)
+_PLANE_OFFSET[BLACK] = np.asarray([(sq // 9) * 9 + 8 - sq % 9 for sq in range(BOARD_SIZE)], dtype=np.intp)
+# 'xy' string of every absolute square seen by the side to move
+_SQUARE_NAMES = [None, None]
+_SQUARE_NAMES[RED] = SQUARE_STR
+_SQUARE_NAMES[BLACK] = SQUARE_STR[::-1]
+# plane of a piece code seen by the side to move, indexed by code * sign + 7
+# 0 ~ 7 : side to move, 7 ~ 14: opponent
+_PLANE_OF_CODE = np.asarray([-c - 1 + 7 if c < 0 else c - 1 for c in range(-7, 8)], dtype=np.intp)
+
+
+def relative_square(sq, turn):
+    return sq if turn == RED else BOARD_SIZE - 1 - sq
+
+
+def parse_move(move, turn):
+    '''
+    move string of the side to move -> (from, to) absolute squares
+    '''
+    fr = int(move[1]) * BOARD_WIDTH + int(move[0])
+    to = int(move[3]) * BOARD_WIDTH + int(move[2])
+    if turn == RED:
+        return fr, to
+    return BOARD_SIZE - 1 - fr, BOARD_SIZE - 1 - to
+
+
+def move_str(fr, to, turn):
+    '''
+    (from, to) absolute squares -> move string of the side to move
+    '''
+    return _SQUARE_NAMES[turn][fr] + _SQUARE_NAMES[turn][to]
+
+
+# move id tables, indexed by the side to move: absolute from / to squares of every move id,
+# and move id of every absolute from * 90 + to (-1 if there is no such move)
+_ID_FROM = [None, None]
+_ID_TO = [None, None]
+_SQUARES_ID = [None, None]
+for _turn in (BLACK, RED):
+    _ID_FROM[_turn] = [relative_square(int(sq), _turn) for sq in Move_From]
+    _ID_TO[_turn] = [relative_square(int(sq), _turn) for sq in Move_To]
+    _SQUARES_ID[_turn] = [-1] * (BOARD_SIZE * BOARD_SIZE)
+    for _id, (_fr, _to) in enumerate(zip(_ID_FROM[_turn], _ID_TO[_turn])):
+        _SQUARES_ID[_turn][_fr * BOARD_SIZE + _to] = _id
+del _turn, _id, _fr, _to
+
+
+def move_id(fr, to, turn):
+    '''
+    (from, to) absolute squares -> move id of the side to move, see lookup_tables.Move_Ids
+    '''
+    return _SQUARES_ID[turn][fr * BOARD_SIZE + to]
+
+
+class Position:
+    '''
+    Array-backed position, an alternative to the state strings of static_env.
+
+    The board is a 90-byte signed array in absolute coordinates: square = y * 9 + x and
+    red starts on rows 0 ~ 4. Red pieces are positive, black pieces negative, 0 is empty.
+    State strings and moves are always written from the side to move, so the public methods
+    convert to / from that relative frame. Moves are integer move ids (lookup_tables.Move_Ids),
+    push also accepts move strings.
+    '''
+    __slots__ = ('board', 'turn', 'pieces', 'kings', 'keys', 'undo')
+
+    def __init__(self):
+        self.board = array('b', bytes(BOARD_SIZE))
+        self.turn = RED
+        self.pieces = [set(), set()]  # indexed by color: squares of that side's pieces
+        self.kings = [-1, -1]  # indexed by color: king square, -1 if captured
+        self.keys = [0, 0]  # indexed by color: zobrist key if that side is to move
+        self.undo = []  # (from, to, captured, red key, black key) of every pushed move
+
+    @property
+    def key(self):
+        '''
+        64-bit zobrist key seen from the side to move, see zobrist.state_hash
+        '''
+        return self.keys[self.turn]
+
+    @classmethod
+    def from_state(cls, state, turn=RED):
+        '''
+        Parse a static_env state string. The state does not record who is to move,
+        it only matters if the caller wants absolute coordinates to be meaningful.
+        '''
+        pos = cls()
+        pos.turn = turn
+        sign = 1 if turn == RED else -1
+        rows = state.split('/')
+        for i in range(BOARD_HEIGHT):
+            x = 0
+            for ch in rows[i]:
+                if ch.isdigit():
+                    x += int(ch)
+                    continue
+                code = CHAR_TO_PIECE[ch.upper()]
+                if ch.islower():
+                    code = -code
+                code *= sign
+                sq = relative_square((9 - i) * BOARD_WIDTH + x, turn)
+                pos.put(sq, code)
+                x += 1
+        return pos
+
+    def to_state(self):
+        '''
+        Serialise to a static_env state string, seen from the side to move
+        '''
+        board = self.board
+        sign = 1 if self.turn == RED else -1
+        black = self.turn == BLACK
+        rows = []
+        for y in range(BOARD_HEIGHT - 1, -1, -1):
+            row = ''
+            c = 0
+            for x in range(BOARD_WIDTH):
+                sq = y * BOARD_WIDTH + x
+                code = board[BOARD_SIZE - 1 - sq] if black else board[sq]
+                if code == EMPTY:
+                    c += 1
+                    continue
+                if c > 0:
+                    row += str(c)
+                    c = 0
+                code *= sign
+                row += PIECE_CHARS[code] if code > 0 else PIECE_CHARS[-code].lower()
+            if c > 0:
+                row += str(c)
+            rows.append(row)
+        return '/'.join(rows)
+
+    def put(self, sq, code):
+        self.board[sq] = code
+        self.keys[RED] ^= PIECE_KEYS[RED][code + 7][sq]
+        self.keys[BLACK] ^= PIECE_KEYS[BLACK][code + 7][sq]
+        color = RED if code > 0 else BLACK
+        self.pieces[color].add(sq)
+        if code == KING or code == -KING:
+            self.kings[color] = sq
+
+    def copy(self):
+        pos = self.__class__.__new__(self.__class__)
+        pos.board = array('b', self.board)
+        pos.turn = self.turn
+        pos.pieces = [set(self.pieces[0]), set(self.pieces[1])]
+        pos.kings = list(self.kings)
+        pos.keys = list(self.keys)
+        pos.undo = []
+        return pos
+
+    def _apply(self, fr, to):
+        board = self.board
+        code = board[fr]
+        if code == EMPTY:
+            raise ValueError(f"No chessman in {move_str(fr, to, self.turn)}, state = {self.to_state()}")
+        captured = board[to]
+        me, op = self.turn, 1 - self.turn
+        red_keys, black_keys = PIECE_KEYS[RED][code + 7], PIECE_KEYS[BLACK][code + 7]
+        keys = self.keys
+        keys[RED] ^= red_keys[fr] ^ red_keys[to]
+        keys[BLACK] ^= black_keys[fr] ^ black_keys[to]
+        if captured != EMPTY:
+            keys[RED] ^= PIECE_KEYS[RED][captured + 7][to]
+            keys[BLACK] ^= PIECE_KEYS[BLACK][captured + 7][to]
+            self.pieces[op].discard(to)
+            if captured == KING or captured == -KING:
+                self.kings[op] = -1
+        board[to] = code
+        board[fr] = EMPTY
+        pieces = self.pieces[me]
+        pieces.discard(fr)
+        pieces.add(to)
+        if code == KING or code == -KING:
+            self.kings[me] = to
+        self.turn = op
+        return captured
+
+    def push(self, action):
+        '''
+        Make the move id (or move string) `action` in place, return the captured piece code (0 if none)
+        '''
+        if isinstance(action, str):
+            return self._push(*parse_move(action, self.turn))
+        return self._push(_ID_FROM[self.turn][action], _ID_TO[self.turn][action])
+
+    def _push(self, fr, to):
+        keys = self.keys
+        undo = (fr, to, self.board[to], keys[RED], keys[BLACK])
+        captured = self._apply(fr, to)
+        self.undo.append(undo)
+        return captured
+
+    def pop(self):
+        '''
+        Unmake the last pushed move, return its move id
+        '''
+        fr, to, captured, red_key, black_key = self.undo.pop()
+        board = self.board
+        me = 1 - self.turn
+        code = board[to]
+        board[fr] = code
+        board[to] = captured
+        pieces = self.pieces[me]
+        pieces.discard(to)
+        pieces.add(fr)
+        if code == KING or code == -KING:
+            self.kings[me] = fr
+        if captured != EMPTY:
+            self.pieces[self.turn].add(to)
+            if captured == KING or captured == -KING:
+                self.kings[self.turn] = to
+        self.keys[RED] = red_key
+        self.keys[BLACK] = black_key
+        self.turn = me
+        return _SQUARES_ID[me][fr * BOARD_SIZE + to]
+
+    @property
+    def ply(self):
+        return len(self.undo)
+
+    def step(self, action):
+        '''
+        Equivalent of static_env.step: return the position after the move string `action`
+        '''
+        pos = self.copy()
+        pos.push(action)
+        return pos
+
+    def new_step(self, action):
+        '''
+        Equivalent of static_env.new_step: return (next position, no_eat)
+        '''
+        pos = self.copy()
+        captured = pos.push(action)
+        return pos, captured == EMPTY
+
+    def _targets(self, sq, code, color):
+        '''
+        Pseudo-legal destination squares of the piece on `sq`, in absolute coordinates
+        '''
+        board = self.board
+        sign = 1 if color == RED else -1
+        kind = code * sign
+        if kind == ROOK:
+            dests = []
+            for ray in RAYS[sq]:
+                for to in ray:
+                    target = board[to]
+                    if target == EMPTY:
+                        dests.append(to)
+                        continue
+                    if target * sign < 0:
+                        dests.append(to)
+                    break
+            return dests
+        if kind == CANNON:
+            dests = []
+            for ray in RAYS[sq]:
+                screen = False
+                for to in ray:
+                    target = board[to]
+                    if not screen:
+                        if target == EMPTY:
+                            dests.append(to)
+                        else:
+                            screen = True
+                    elif target != EMPTY:
+                        if target * sign < 0:
+                            dests.append(to)
+                        break
+            return dests
+        if kind == KNIGHT or kind == ELEPHANT:
+            # the knight's leg / the elephant's eye must be empty
+            table = KNIGHT_MOVES[sq] if kind == KNIGHT else ELEPHANT_MOVES[color][sq]
+            return [to for to, block in table if board[block] == EMPTY and board[to] * sign <= 0]
+        if kind == PAWN:
+            return [to for to in PAWN_MOVES[color][sq] if board[to] * sign <= 0]
+        if kind == MANDARIN:
+            return [to for to in MANDARIN_MOVES[color][sq] if board[to] * sign <= 0]
+        dests = [to for to in KING_MOVES[color][sq] if board[to] * sign <= 0]
+        # flying king: capture the opponent king on an open file
+        for to in RAYS[sq][FORWARD[color]]:
+            if board[to] != EMPTY:
+                if board[to] == -code:
+                    dests.append(to)
+                break
+        return dests
+
+    def get_legal_moves(self):
+        '''
+        Equivalent of static_env.get_legal_moves: move ids of the side to move
+        '''
+        turn = self.turn
+        board = self.board
+        ids = _SQUARES_ID[turn]
+        legal_moves = []
+        for sq in sorted(self.pieces[turn], reverse=turn == BLACK):
+            base = sq * BOARD_SIZE
+            for to in self._targets(sq, board[sq], turn):
+                legal_moves.append(ids[base + to])
+        return legal_moves
+
+    def _iter_attackers(self, sq, by):
+        '''
+        Squares of the pieces of `by` that could capture a piece standing on `sq`.
+        Reverse lookups from `sq`: rays for rooks, cannons and the flying king, then the leapers
+        '''
+        board = self.board
+        sign = 1 if by == RED else -1
+        rook, cannon, king = ROOK * sign, CANNON * sign, KING * sign
+        king_ray = FORWARD[1 - by] if sq == self.kings[1 - by] else -1
+        for direction, ray in enumerate(RAYS[sq]):
+            screen = False
+            for fr in ray:
+                code = board[fr]
+                if code == EMPTY:
+                    continue
+                if screen:
+                    if code == cannon:
+                        yield fr
+                    break
+                if code == rook or (code == king and direction == king_ray):
+                    yield fr
+                screen = True
+        knight = KNIGHT * sign
+        for fr, leg in KNIGHT_ATTACKS[sq]:
+            if board[fr] == knight and board[leg] == EMPTY:
+                yield fr
+        pawn = PAWN * sign
+        for fr in PAWN_ATTACKS[by][sq]:
+            if board[fr] == pawn:
+                yield fr
+        for fr in KING_MOVES[by][sq]:
+            if board[fr] == king:
+                yield fr
+        mandarin = MANDARIN * sign
+        for fr in MANDARIN_MOVES[by][sq]:
+            if board[fr] == mandarin:
+                yield fr
+        if OWN_HALF[by][sq]:
+            elephant = ELEPHANT * sign
+            for fr, eye in ELEPHANT_MOVES[by][sq]:
+                if board[fr] == elephant and board[eye] == EMPTY:
+                    yield fr
+
+    def attacker(self, sq, by):
+        '''
+        Square of a piece of `by` that could capture a piece standing on `sq`, -1 if none
+        '''
+        return next(self._iter_attackers(sq, by), -1)
+
+    def attacker_squares(self, sq, by):
+        return list(self._iter_attackers(sq, by))
+
+    def is_attacked(self, sq, by):
+        '''
+        Could a piece of `by` capture a piece standing on `sq`
+        '''
+        return self.attacker(sq, by) >= 0
+
+    def done(self, need_check=False):
+        '''
+        Equivalent of static_env.done, final_move is a move id
+        '''
+        me, op = self.turn, 1 - self.turn
+        winner = None
+        v = 0
+        final_move = None
+        check = False
+        if self.kings[op] < 0:
+            winner, v = me, 1
+        elif self.kings[me] < 0:
+            winner, v = op, -1
+        else:
+            my_k, op_k = self.kings[me], self.kings[op]
+            if my_k % BOARD_WIDTH == op_k % BOARD_WIDTH:
+                lo, hi = min(my_k, op_k), max(my_k, op_k)
+                if all(self.board[sq] == EMPTY for sq in range(lo + BOARD_WIDTH, hi, BOARD_WIDTH)):
+                    winner, v = me, 1
+            if winner is None:
+                fr = self.attacker(op_k, me)
+                if fr >= 0:
+                    winner, v = me, 1
+                    final_move = move_id(fr, op_k, me)
+            if winner is None and need_check:
+                check = self.is_attacked(my_k, op)
+        if need_check:
+            return (winner is not None, v, final_move, check)
+        else:
+            return (winner is not None, v, final_move)
+
+    def is_check_or_catch(self, skip_unpromoted_pawns=False):
+        '''
+        Called after a move: does the side that just moved check the opponent king, or catch (捉)
+        a piece, i.e. attack a piece that can not be captured back.
+        static_env.will_check_or_catch_by_moves meant to exempt pawns that have not crossed the
+        river, but its test never matches, so they count by default; skip_unpromoted_pawns exempts them.
+        '''
+        op = self.turn
+        me = 1 - op
+        if self.kings[op] >= 0 and self.is_attacked(self.kings[op], me):
+            return True
+        board = self.board
+        pawn = PAWN if op == RED else -PAWN
+        if not skip_unpromoted_pawns:
+            pawn = None
+        self.turn = me  # null move, the side that just moved captures
+        try:
+            for target in list(self.pieces[op]):
+                if board[target] == pawn and OWN_HALF[op][target]:
+                    continue
+                for fr in self.attacker_squares(target, me):
+                    self._push(fr, target)
+                    defended = self.is_attacked(target, op)
+                    self.pop()
+                    if not defended:
+                        return True
+            return False
+        finally:
+            self.turn = op
+
+    def to_planes(self, out=None):
+        '''
+        Equivalent of static_env.state_to_planes: (14, 10, 9) planes seen from the side to move
+        '''
+        planes = np.zeros(shape=(14, 10, 9), dtype=np.float32) if out is None else out
+        if out is not None:
+            planes[...] = 0
+        board = np.frombuffer(self.board, dtype=np.int8)
+        squares = np.flatnonzero(board)
+        sign = 1 if self.turn == RED else -1
+        index = _PLANE_OF_CODE[board[squares] * sign + 7] * BOARD_SIZE + _PLANE_OFFSET[self.turn][squares]
+        planes.put(index, 1)
+        return planes
+
+    def previous(self, plies=2):
+        '''
+        Copy of the position `plies` pushed moves ago, None if fewer moves were pushed
+        '''
+        if self.ply < plies:
+            return None
+        moves = [self.pop() for _ in range(plies)]
+        pos = self.copy()
+        for move in reversed(moves):
+            self.push(move)
+        return pos
+
+    def to_history_planes(self, last=None):
+        '''
+        Equivalent of static_env.state_history_to_planes: (28, 10, 9) planes.
+        `last` is the position of the same side one move earlier (history[-5]),
+        by default it is taken from the last two pushed moves, if any
+        '''
+        planes = np.zeros(shape=(28, 10, 9), dtype=np.float32)
+        self.to_planes(out=planes[:14])
+        if last is None:
+            last = self.previous()
+        if last is not None:
+            last.to_planes(out=planes[14:])
+        return planes
+
+    def __repr__(self):
+        return f"Position('{self.to_state()}', turn={'red' if self.turn == RED else 'black'})"
@@ -0,0 +1,66 @@
+from collections import defaultdict
+
+import src.environment.light.static_env as senv
+from src.environment.light.zobrist import state_hash
+
+
+class RepetitionTracker:
+    '''
+    Occurrences of the positions of one game, keyed by the zobrist key of the state.
+    For every occurrence it records its index in the game and the move played from it,
+    so a repeated position, its forbidden moves (长将 / 长捉) and idle moves (闲着)
+    are found without scanning the history.
+
+    usage: push(state) for every position reached, play(action) for every move made
+    '''
+
+    def __init__(self, state=None):
+        self.occurrences = defaultdict(list)  # key: zobrist key, value: [[index, action]] in game order
+        self.key = None  # zobrist key of the current position
+        self.index = -1  # index of the current position, in positions
+        self.catch_cache = {}  # key: (zobrist key, action), value: will_check_or_catch
+        if state is not None:
+            self.push(state)
+
+    def push(self, state):
+        '''
+        Record the position `state` reached in the game
+        '''
+        self.index += 1
+        self.key = state_hash(state)
+        self.occurrences[self.key].append([self.index, None])
+
+    def play(self, action):
+        '''
+        Record the move played from the current position
+        '''
+        self.occurrences[self.key][-1][1] = action
+
+    def is_repeated(self):
+        return len(self.occurrences[self.key]) > 1
+
+    def previous_actions(self):
+        '''
+        Moves played from the earlier occurrences of the current position
+        '''
+        return [action for _, action in self.occurrences[self.key][:-1] if action is not None]
+
+    def no_act(self, state, max_free_move=2):
+        '''
+        return (no_act, free_move) of the current position `state`:
+        no_act: moves played from it before that check or catch (将军或捉), they are forbidden now
+        free_move: number of the other moves played from it (闲着), stops counting at max_free_move
+        '''
+        no_act = []
+        free_move = 0
+        for action in self.previous_actions():
+            cache_key = (self.key, action)
+            if cache_key not in self.catch_cache:
+                self.catch_cache[cache_key] = senv.will_check_or_catch(state, action)
+            if self.catch_cache[cache_key]:
+                no_act.append(action)
+            else:
+                free_move += 1
+                if free_move >= max_free_move:
+                    break
+        return no_act, free_move
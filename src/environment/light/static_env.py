@@ -1,8 +1,14 @@
 import numpy as np
 from logging import getLogger
 
-from src.environment.light.common import move_to_str, mov_dir, state_to_board_dict, replace_dict
-from src.environment.light.lookup_tables import Winner, Fen_2_Idx
+from src.environment.light.common import state_to_board_dict, replace_dict
+from src.environment.light.lookup_tables import ActionLabelsRed, flip_move
+from src.environment.light.common import RED
+from src.environment.light.move_tables import BOARD_SIZE, SQUARE_STR, RAYS, UP, KNIGHT_MOVES, ELEPHANT_MOVES, \
+    MANDARIN_MOVES, KING_MOVES, PAWN_MOVES
+from src.environment.light.position import Position, EMPTY
+from src.environment.light.bitboard import BitboardPosition
+from src.environment.light.planes import states_to_planes
 
 logger = getLogger(__name__)
 
@@ -11,94 +17,49 @@ INIT_STATE = 'rkemsmekr/9/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C5C1/9/RKEMSMEKR'
 BOARD_HEIGHT = 10
 BOARD_WIDTH = 9
 
+# position classes of the selectable move-generation backends
+BACKENDS = {'board': Position, 'bitboard': BitboardPosition}
+_backend = 'board'
+
+
+def set_backend(name):
+    '''
+    Select the move-generation backend used by new_position, get_legal_moves and done
+    '''
+    global _backend
+    if name not in BACKENDS:
+        raise RuntimeError(f'未知后端:{name}')
+    _backend = name
+
+
+def get_backend():
+    return _backend
+
+
+def new_position(state, turn=RED):
+    '''
+    Parse `state` into a position of the selected backend
+    '''
+    return BACKENDS[_backend].from_state(state, turn)
+
 
 def done(state, turns=-1, need_check=False):
-    if 's' not in state:
-        return (True, 1, None)
-    if 'S' not in state:
-        return (True, -1, None)
-    # if turns > 0 and turns < 20:
-    #     return (False, 0, None)
-    board = state_to_board(state)
-    red_k, black_k = [0, 0], [0, 0]
-    winner = None
-    v = 0
-    for i in range(BOARD_HEIGHT):
-        for j in range(BOARD_WIDTH):
-            if board[i][j] == 'k':
-                red_k[0] = i
-                red_k[1] = j
-            if board[i][j] == 'K':
-                black_k[0] = i
-                black_k[1] = j
-    if red_k[0] == 0 and red_k[1] == 0:
-        winner = Winner.black
-        v = -1
-    elif black_k[0] == 0 and black_k[1] == 0:
-        winner = Winner.red
-        v = 1
-    elif red_k[1] == black_k[1]:
-        has_block = False
-        i = red_k[0] + 1
-        while i < black_k[0]:
-            if board[i][red_k[1]] != '.':
-                has_block = True
-                break
-            i += 1
-        if not has_block:
-            v = 1
-            winner = Winner.red
-    final_move = None
-    check = False
-    if winner is None:
-        legal_moves = get_legal_moves(state, board)
-        for mov in legal_moves:
-            dest = [int(mov[3]), int(mov[2])]
-            if dest == black_k:
-                winner = Winner.red
-                v = 1
-                final_move = mov
-                break
-    if winner is None and need_check:
-        black_state = fliped_state(state)
-        black_moves = get_legal_moves(black_state)
-        # render(black_state)
-        red_k[0] = 9 - red_k[0]
-        red_k[1] = 8 - red_k[1]
-        for mov in black_moves:
-            dest = [int(mov[3]), int(mov[2])]
-            if dest == red_k:
-                check = True
-                # logger.debug(f"Checking move {mov}")
-                break
-        # logger.debug(f"red_k = {red_k}, black_moves = {black_moves}, check = {check}")
-    if need_check:
-        return (winner is not None, v, final_move, check)
-    else:
-        return (winner is not None, v, final_move)
+    '''
+    Terminal / check detection from the kings' squares, see Position.done (final_move is a move id)
+    '''
+    return new_position(state).done(need_check)
 
 
 def step(state, action):
-    board = state_to_board(state)
-    if board[int(action[1])][int(action[0])] == '.':
-        raise ValueError(f"No chessman in {action}, state = {state}")
-    board[int(action[3])][int(action[2])] = board[int(action[1])][int(action[0])]
-    board[int(action[1])][int(action[0])] = '.'
-    state = board_to_state(board)
-    return fliped_state(state)
+    pos = Position.from_state(state)
+    pos.push(action)
+    return pos.to_state()
 
 
 def new_step(state, action):
-    no_eat = True
-    board = state_to_board(state)
-    if board[int(action[1])][int(action[0])] == '.':
-        raise ValueError(f"No chessman in {action}, state = {state}")
-    if board[int(action[3])][int(action[2])] != '.':
-        no_eat = False
-    board[int(action[3])][int(action[2])] = board[int(action[1])][int(action[0])]
-    board[int(action[1])][int(action[0])] = '.'
-    state = board_to_state(board)
-    return fliped_state(state), no_eat
+    pos = Position.from_state(state)
+    no_eat = pos.push(action) == EMPTY
+    return pos.to_state(), no_eat
 
 
 def evaluate(state):
@@ -146,20 +107,7 @@ def state_to_planes(state):
         rkemsmekr/9/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C5C1/9/RKEMSMEKR
         rkemsmek1/8r/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C5C1/9/RKEMSMEKR
     '''
-    planes = np.zeros(shape=(14, 10, 9), dtype=np.float32)
-    rows = state.split('/')
-
-    for i in range(len(rows)):
-        row = rows[i]
-        j = 0
-        for letter in row:
-            if letter.isalpha():
-                # 0 ~ 7 : upper, 7 ~ 14: lower
-                planes[Fen_2_Idx[letter] + int(letter.islower()) * 7][i][j] = 1
-                j += 1
-            else:
-                j += int(letter)
-    return planes
+    return states_to_planes([state])[0]
 
 
 def state_history_to_planes(state, history):
@@ -168,35 +116,10 @@ def state_history_to_planes(state, history):
         rkemsmekr/9/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C5C1/9/RKEMSMEKR
         rkemsmek1/8r/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C5C1/9/RKEMSMEKR
     '''
-    planes = np.zeros(shape=(28, 10, 9), dtype=np.float32)
-    rows = state.split('/')
-    # 0 ~ 14 for current state
-    for i in range(len(rows)):
-        row = rows[i]
-        j = 0
-        for letter in row:
-            if letter.isalpha():
-                # 0 ~ 7 : upper, 7 ~ 14: lower
-                planes[Fen_2_Idx[letter] + int(letter.islower()) * 7][i][j] = 1
-                j += 1
-            else:
-                j += int(letter)
-    # 14 ~ 28 for last state
+    # 0 ~ 14 for current state, 14 ~ 28 for last state
     # history = [...,last state, red action, black state, black action, current state]
-    if history and len(history) >= 5:
-        last_state = history[-5]
-        rows = last_state.split('/')
-        for i in range(len(rows)):
-            row = rows[i]
-            j = 0
-            for letter in row:
-                if letter.isalpha():
-                    # 0 ~ 7 : upper, 7 ~ 14: lower
-                    planes[Fen_2_Idx[letter] + int(letter.islower()) * 7 + 14][i][j] = 1
-                    j += 1
-                else:
-                    j += int(letter)
-    return planes
+    last_state = history[-5] if history and len(history) >= 5 else None
+    return states_to_planes([state], [last_state])[0]
 
 
 def board_to_state(board):
@@ -269,70 +192,59 @@ def fliped_state(state):
 
 
 def get_legal_moves(state, board=None):
+    if _backend == 'bitboard' and board is None:
+        return [ActionLabelsRed[move] for move in BitboardPosition.from_state(state).get_legal_moves()]
     board = board if board is not None else state_to_board(state)
+    flat = [ch for row in board for ch in row]
     legal_moves = []
-    for y in range(BOARD_HEIGHT):
-        for x in range(BOARD_WIDTH):
-            ch = board[y][x]
-            if not ch.islower():
-                continue
-            if ch in mov_dir:
-                for d in mov_dir[ch]:
-                    x_ = x + d[0]
-                    y_ = y + d[1]
-                    if not can_move(board, x_, y_):
-                        continue
-                    elif ch == 'p' and y < 5 and x_ != x:  # for red pawn
+    for sq in range(BOARD_SIZE):
+        ch = flat[sq]
+        if not ch.islower():
+            continue
+        src = SQUARE_STR[sq]
+        if ch == 'r':  # for rook
+            for ray in RAYS[sq]:
+                for to in ray:
+                    if flat[to] == '.':
+                        legal_moves.append(src + SQUARE_STR[to])
                         continue
-                    elif ch == 'n' or ch == 'b':  # for knight and bishop
-                        if board[y + int(d[1] / 2)][x + int(d[0] / 2)] != '.':
-                            continue
-                        elif ch == 'b' and y_ > 4:
-                            continue
-                    elif ch == 'k' or ch == 'a':  # for king and advisor
-                        if x_ < 3 or x_ > 5:
-                            continue
-                        if y_ > 2:
-                            continue
-                    legal_moves.append(move_to_str(x, y, x_, y_))
-                    if (ch == 'k'):  # for King to King check
-                        d, u = y_board_from(board, x, y)
-                        if (u < BOARD_HEIGHT and board[u][x] == 'K'):
-                            legal_moves.append(move_to_str(x, y, x, u))
-
-            elif ch == 'r' or ch == 'c':  # for connon and rook
-                l, r = x_board_from(board, x, y)
-                d, u = y_board_from(board, x, y)
-                for x_ in range(l + 1, x):
-                    legal_moves.append(move_to_str(x, y, x_, y))
-                for x_ in range(x + 1, r):
-                    legal_moves.append(move_to_str(x, y, x_, y))
-                for y_ in range(d + 1, y):
-                    legal_moves.append(move_to_str(x, y, x, y_))
-                for y_ in range(y + 1, u):
-                    legal_moves.append(move_to_str(x, y, x, y_))
-                if ch == 'r':  # for rook
-                    if can_move(board, l, y):
-                        legal_moves.append(move_to_str(x, y, l, y))
-                    if can_move(board, r, y):
-                        legal_moves.append(move_to_str(x, y, r, y))
-                    if can_move(board, x, d):
-                        legal_moves.append(move_to_str(x, y, x, d))
-                    if can_move(board, x, u):
-                        legal_moves.append(move_to_str(x, y, x, u))
-                else:  # for connon
-                    l_, _ = x_board_from(board, l, y)
-                    _, r_ = x_board_from(board, r, y)
-                    d_, _ = y_board_from(board, x, d)
-                    _, u_ = y_board_from(board, x, u)
-                    if can_move(board, l_, y):
-                        legal_moves.append(move_to_str(x, y, l_, y))
-                    if can_move(board, r_, y):
-                        legal_moves.append(move_to_str(x, y, r_, y))
-                    if can_move(board, x, d_):
-                        legal_moves.append(move_to_str(x, y, x, d_))
-                    if can_move(board, x, u_):
-                        legal_moves.append(move_to_str(x, y, x, u_))
+                    if flat[to].isupper():
+                        legal_moves.append(src + SQUARE_STR[to])
+                    break
+        elif ch == 'c':  # for connon
+            for ray in RAYS[sq]:
+                screen = False
+                for to in ray:
+                    if not screen:
+                        if flat[to] == '.':
+                            legal_moves.append(src + SQUARE_STR[to])
+                        else:
+                            screen = True
+                    elif flat[to] != '.':
+                        if flat[to].isupper():
+                            legal_moves.append(src + SQUARE_STR[to])
+                        break
+        elif ch == 'n' or ch == 'b':  # for knight and bishop, the leg / eye must be empty
+            table = KNIGHT_MOVES[sq] if ch == 'n' else ELEPHANT_MOVES[RED][sq]
+            for to, block in table:
+                if flat[block] == '.' and not flat[to].islower():
+                    legal_moves.append(src + SQUARE_STR[to])
+        else:
+            if ch == 'p':
+                table = PAWN_MOVES[RED][sq]
+            elif ch == 'a':
+                table = MANDARIN_MOVES[RED][sq]
+            else:
+                table = KING_MOVES[RED][sq]
+            for to in table:
+                if not flat[to].islower():
+                    legal_moves.append(src + SQUARE_STR[to])
+            if ch == 'k':  # for King to King check
+                for to in RAYS[sq][UP]:
+                    if flat[to] != '.':
+                        if flat[to] == 'K':
+                            legal_moves.append(src + SQUARE_STR[to])
+                        break
     return legal_moves
 
 
@@ -414,6 +326,16 @@ def to_uci_move(action):
 def will_check_or_catch(state, action):
     '''
     判断走了下一步是否会造成红方将军或捉子
+    Attack map of the moved side, then a defence lookup for every capture, see Position.is_check_or_catch
+    '''
+    pos = new_position(state)
+    pos.push(action)
+    return pos.is_check_or_catch()
+
+
+def will_check_or_catch_by_moves(state, action):
+    '''
+    Reference implementation of will_check_or_catch by move generation, kept for check_catch_regression
     '''
     state = step(state, action)  # 判断当前state的红方是否会被将/捉
     board = state_to_board(state)
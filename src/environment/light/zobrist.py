@@ -0,0 +1,45 @@
+from random import Random
+
+from src.environment.light.common import RED, BLACK
+
+# Zobrist keys of the light environment.
+# Keys are computed from the point of view of the side to move, exactly like the state
+# strings of static_env: a position and its colour-flipped twin share one key. A Position
+# keeps both the "red to move" and the "black to move" key up to date on every move and
+# exposes the one that matches its turn.
+
+BOARD_SIZE = 90
+ZOBRIST_SEED = 20180513  # fixed, so keys are identical in every process
+
+_rand = Random(ZOBRIST_SEED)
+# key of piece code c (-7 ~ 7) on relative square sq: ZOBRIST[c + 7][sq]
+ZOBRIST = [[_rand.getrandbits(64) if c != 7 else 0 for _ in range(BOARD_SIZE)] for c in range(15)]
+del _rand
+
+# key contribution of an absolute (code, square), indexed by the side to move:
+# PIECE_KEYS[turn][code + 7][sq]
+PIECE_KEYS = [None, None]
+PIECE_KEYS[RED] = ZOBRIST
+PIECE_KEYS[BLACK] = [[ZOBRIST[14 - c][BOARD_SIZE - 1 - sq] for sq in range(BOARD_SIZE)] for c in range(15)]
+
+_CHAR_CODE = {'P': 1, 'C': 2, 'R': 3, 'K': 4, 'E': 5, 'M': 6, 'S': 7}
+
+
+def state_hash(state):
+    '''
+    64-bit key of a static_env state string, equal to Position.from_state(state).key
+    '''
+    key = 0
+    y = 9
+    x = 0
+    for ch in state:
+        if ch == '/':
+            y -= 1
+            x = 0
+        elif ch.isdigit():
+            x += int(ch)
+        else:
+            code = _CHAR_CODE[ch] if ch.isupper() else -_CHAR_CODE[ch.upper()]
+            key ^= ZOBRIST[code + 7][y * 9 + x]
+            x += 1
+    return key
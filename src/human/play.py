@@ -3,7 +3,6 @@ import pygame
 import os.path
 from pygame.locals import *
 from logging import getLogger
-from collections import defaultdict
 from threading import Thread
 from time import sleep
 from datetime import datetime
@@ -11,10 +10,12 @@ from datetime import datetime
 import src.environment.light.static_env as senv
 from src.environment.visual.chessman import *
 from src.agent.model import CChessModel
-from src.agent.mcts import CChessPlayer, VisitState
+from src.agent.mcts import CChessPlayer, SearchTree
 from src.config import Config
 from src.environment.visual.env import CChessEnv
-from src.environment.light.lookup_tables import flip_move
+from src.environment.light.lookup_tables import ActionLabelsRed, flip_move, move_to_id
+from src.environment.light.zobrist import state_hash
+from src.environment.light.repetition import RepetitionTracker
 from src.utils.model_helper import load_best_model_weight
 
 logger = getLogger(__name__)
@@ -47,7 +48,7 @@ class PlayWithHuman:
         self.rec_labels = [None] * self.disp_record_num
         self.nn_value = 0
         self.mcts_moves = {}
-        self.history = []
+        self.repetition = RepetitionTracker()  # positions and moves of the game
         if self.config.opts.bg_style == 'WOOD':
             self.chessman_w += 1
             self.chessman_h += 1
@@ -92,7 +93,7 @@ class PlayWithHuman:
         self.env.reset()
         self.load_model()
         self.pipe = self.model.get_pipes()
-        self.ai = CChessPlayer(self.config, search_tree=defaultdict(VisitState), pipes=self.pipe,
+        self.ai = CChessPlayer(self.config, search_tree=SearchTree(), pipes=self.pipe,
                                enable_resign=True, debugging=True)
         self.human_move_first = human_first
 
@@ -143,25 +144,27 @@ class PlayWithHuman:
                                         move = str(current_chessman.chessman.col_num) + str(
                                             current_chessman.chessman.row_num) + \
                                                str(col_num) + str(row_num)
+                                        is_red = current_chessman.chessman.is_red
                                         success = current_chessman.move(col_num, row_num, self.chessman_w,
                                                                         self.chessman_h)
-                                        self.history.append(move)
                                         if success:
+                                            self.play_human_move(move, is_red)
                                             self.chessmans.remove(chessman_sprite)
                                             chessman_sprite.kill()
                                             current_chessman.is_selected = False
                                             current_chessman = None
-                                            self.history.append(self.env.get_state())
+                                            self.repetition.push(self.env.get_state())
                                 elif current_chessman != None and chessman_sprite is None:
                                     move = str(current_chessman.chessman.col_num) + str(
                                         current_chessman.chessman.row_num) + \
                                            str(col_num) + str(row_num)
+                                    is_red = current_chessman.chessman.is_red
                                     success = current_chessman.move(col_num, row_num, self.chessman_w, self.chessman_h)
-                                    self.history.append(move)
                                     if success:
+                                        self.play_human_move(move, is_red)
                                         current_chessman.is_selected = False
                                         current_chessman = None
-                                        self.history.append(self.env.get_state())
+                                        self.repetition.push(self.env.get_state())
 
             self.draw_widget(screen, widget_background)
             framerate.tick(20)
@@ -182,9 +185,17 @@ class PlayWithHuman:
         self.env.board.save_record(path)
         sleep(3)
 
+    def play_human_move(self, move, is_red):
+        '''
+        Record the human move (board coordinates) in the mover's frame
+        '''
+        if not is_red:
+            move = flip_move(move)
+        self.repetition.play(move_to_id(move))
+
     def ai_move(self):
         ai_move_first = not self.human_move_first
-        self.history = [self.env.get_state()]
+        self.repetition = RepetitionTracker(self.env.get_state())
         no_act = None
         while not self.env.done:
             if ai_move_first == self.env.red_to_move:
@@ -192,32 +203,24 @@ class PlayWithHuman:
                 state = self.env.get_state()
                 logger.info(f"state = {state}")
                 _, _, _, check = senv.done(state, need_check=True)
-                if not check and state in self.history[:-1]:
-                    no_act = []
-                    free_move = defaultdict(int)
-                    for i in range(len(self.history) - 1):
-                        if self.history[i] == state:
-                            # 如果走了下一步是将军或捉：禁止走那步
-                            if senv.will_check_or_catch(state, self.history[i + 1]):
-                                no_act.append(self.history[i + 1])
-                            # 否则当作闲着处理
-                            else:
-                                free_move[state] += 1
-                                if free_move[state] >= 2:
-                                    # 作和棋处理
-                                    self.env.winner = Winner.draw
-                                    self.env.board.winner = Winner.draw
-                                    break
+                if not check and self.repetition.is_repeated():
+                    # 如果走了下一步是将军或捉：禁止走那步，否则当作闲着处理
+                    no_act, free_move = self.repetition.no_act(state)
+                    if free_move >= 2:
+                        # 作和棋处理
+                        self.env.winner = Winner.draw
+                        self.env.board.winner = Winner.draw
                     if no_act:
                         logger.debug(f"no_act = {no_act}")
                 action, policy = self.ai.action(state, self.env.num_halfmoves, no_act)
                 if action is None:
                     logger.info("AI has resigned!")
                     return
-                self.history.append(action)
+                self.repetition.play(action)
+                action = ActionLabelsRed[action]
                 if not self.env.red_to_move:
                     action = flip_move(action)
-                key = self.env.get_state()
+                key = state_hash(self.env.get_state())
                 p, v = self.ai.debug[key]
                 logger.info(f"check = {check}, NN value = {v:.3f}")
                 self.nn_value = v
@@ -235,7 +238,7 @@ class PlayWithHuman:
                     self.chessmans.remove(sprite_dest)
                     sprite_dest.kill()
                 chessman_sprite.move(x1, y1, self.chessman_w, self.chessman_h)
-                self.history.append(self.env.get_state())
+                self.repetition.push(self.env.get_state())
 
     def draw_widget(self, screen, widget_background):
         white_rect = Rect(0, 0, self.screen_width - self.width, self.height)
@@ -12,6 +12,7 @@ CMD_LIST = ['self', 'opt', 'eval', 'play', 'eval', 'sl', 'ob']
 PIECE_STYLE_LIST = ['WOOD', 'POLISH', 'DELICATE']
 BG_STYLE_LIST = ['CANVAS', 'DROPS', 'GREEN', 'QIANHONG', 'SHEET', 'SKELETON', 'WHITE', 'WOOD']
 RANDOM_LIST = ['none', 'small', 'medium', 'large']
+BACKEND_LIST = ['board', 'bitboard']
 
 def create_parser():
     parser = argparse.ArgumentParser()
@@ -30,6 +31,8 @@ def create_parser():
     parser.add_argument("--random", help="choose a style of randomness", choices=RANDOM_LIST, default="none")
     parser.add_argument("--distributed", help="whether upload/download file from remote server", action="store_true")
     parser.add_argument("--elo", help="whether to compute elo score", action="store_true")
+    parser.add_argument("--env-backend", help="move generation backend of the light environment",
+                        choices=BACKEND_LIST, default="board")
     return parser
 
 def setup(config: Config, args):
@@ -37,6 +40,7 @@ def setup(config: Config, args):
     if args.total_step is not None:
         config.trainer.start_total_steps = args.total_step
     config.opts.device_list = args.gpu
+    config.opts.env_backend = args.env_backend
     config.resource.create_directories()
     if args.cmd == 'self':
         setup_logger(config.resource.main_log_path)
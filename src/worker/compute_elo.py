@@ -6,12 +6,12 @@ from datetime import datetime
 from logging import getLogger
 from multiprocessing import Manager
 from time import time, sleep
-from collections import defaultdict
 from random import random, randint
 
 import src.environment.light.static_env as senv
+from src.environment.light.repetition import RepetitionTracker
 from src.agent.model import CChessModel
-from src.agent.mcts import CChessPlayer, VisitState
+from src.agent.mcts import CChessPlayer, SearchTree
 from src.config import Config
 from src.utils.data_helper import write_game_data_to_file
 from src.utils.model_helper import load_model_weight
@@ -127,8 +127,8 @@ class EvaluateWorker:
 
         pipe1 = self.pipes_bt.pop()
         pipe2 = self.pipes_ng.pop()
-        search_tree1 = defaultdict(VisitState)
-        search_tree2 = defaultdict(VisitState)
+        search_tree1 = SearchTree()
+        search_tree2 = SearchTree()
 
         self.player1 = CChessPlayer(self.config, search_tree=search_tree1, pipes=pipe1, 
                         debugging=False, enable_resign=False, use_history=self.hist_base)
@@ -147,6 +147,7 @@ class EvaluateWorker:
 
         state = senv.INIT_STATE
         history = [state]
+        repetition = RepetitionTracker(state)
         value = 0       # best model's value
         turns = 0       # even == red; odd == black
         game_over = False
@@ -156,23 +157,14 @@ class EvaluateWorker:
         while not game_over:
             start_time = time()
             no_act = None
-            if not check and state in history[:-1]:
-                no_act = []
-                free_move = defaultdict(int)
-                for i in range(len(history) - 1):
-                    if history[i] == state:
-                        # 如果走了下一步是将军或捉：禁止走那步
-                        if senv.will_check_or_catch(state, history[i+1]):
-                            no_act.append(history[i + 1])
-                        # 否则当作闲着处理
-                        else:
-                            free_move[state] += 1
-                            if free_move[state] >= 2:
-                                # 作和棋处理
-                                game_over = True
-                                value = 0
-                                logger.info("闲着循环三次，作和棋处理")
-                                break
+            if not check and repetition.is_repeated():
+                # 如果走了下一步是将军或捉：禁止走那步，否则当作闲着处理
+                no_act, free_move = repetition.no_act(state)
+                if free_move >= 2:
+                    # 作和棋处理
+                    game_over = True
+                    value = 0
+                    logger.info("闲着循环三次，作和棋处理")
             if game_over:
                 break
             if turns % 2 == 0:
@@ -187,6 +179,7 @@ class EvaluateWorker:
                 value = -1
                 break
             history.append(action)
+            repetition.play(action)
             state, no_eat = senv.new_step(state, action)
             turns += 1
             if no_eat:
@@ -194,6 +187,7 @@ class EvaluateWorker:
             else:
                 no_eat_count = 0
             history.append(state)
+            repetition.push(state)
 
             if no_eat_count >= 120 or turns / 2 >= self.config.play.max_game_length:
                 game_over = True
@@ -206,7 +200,7 @@ class EvaluateWorker:
                         game_over = True
                         value = 0
 
-        if final_move:
+        if final_move is not None:
             history.append(final_move)
             state = senv.step(state, final_move)
             turns += 1
@@ -1,5 +1,4 @@
 import os
-import gc
 import sys
 import hashlib
 import numpy as np
@@ -8,16 +7,16 @@ from datetime import datetime
 from logging import getLogger
 from multiprocessing import Manager
 from time import time
-from collections import defaultdict
 from threading import Lock
 from time import sleep
 from random import random, randint
 
 import src.environment.light.static_env as senv
+from src.environment.light.repetition import RepetitionTracker
 from src.agent.model import CChessModel
-from src.agent.mcts import CChessPlayer, VisitState
+from src.agent.mcts import CChessPlayer, SearchTree
 from src.config import Config
-from src.environment.light.lookup_tables import ActionLabelsRed, flip_policy
+from src.environment.light.lookup_tables import ActionLabelsRed, flip_policy, move_to_id
 from src.utils.data_helper import write_game_data_to_file
 from src.utils.model_helper import load_model_weight
 from src.utils.tf_helper import set_session_config
@@ -206,9 +205,9 @@ def self_play_buffer(config, pipes_bt, pipes_ng, idx, res_data) -> (tuple, list)
     pipe1 = pipes_bt.pop() # borrow
     pipe2 = pipes_ng.pop()
 
-    player1 = CChessPlayer(config, search_tree=defaultdict(VisitState), pipes=pipe1, 
+    player1 = CChessPlayer(config, search_tree=SearchTree(), pipes=pipe1, 
         enable_resign=False, debugging=False)
-    player2 = CChessPlayer(config, search_tree=defaultdict(VisitState), pipes=pipe2, 
+    player2 = CChessPlayer(config, search_tree=SearchTree(), pipes=pipe2, 
         enable_resign=False, debugging=False)
 
     # even: bst = red, ng = black; odd: bst = black, ng = red
@@ -223,6 +222,7 @@ def self_play_buffer(config, pipes_bt, pipes_ng, idx, res_data) -> (tuple, list)
 
     state = senv.INIT_STATE
     history = [state]
+    repetition = RepetitionTracker(state)
     # policys = [] 
     value = 0
     turns = 0
@@ -233,23 +233,14 @@ def self_play_buffer(config, pipes_bt, pipes_ng, idx, res_data) -> (tuple, list)
 
     while not game_over:
         no_act = None
-        if not check and state in history[:-1]:
-            no_act = []
-            free_move = defaultdict(int)
-            for i in range(len(history) - 1):
-                if history[i] == state:
-                    # 如果走了下一步是将军或捉：禁止走那步
-                    if senv.will_check_or_catch(state, history[i+1]):
-                        no_act.append(history[i + 1])
-                    # 否则当作闲着处理
-                    else:
-                        free_move[state] += 1
-                        if free_move[state] >= 2:
-                            # 作和棋处理
-                            game_over = True
-                            value = 0
-                            logger.info("闲着循环三次，作和棋处理")
-                            break
+        if not check and repetition.is_repeated():
+            # 如果走了下一步是将军或捉：禁止走那步，否则当作闲着处理
+            no_act, free_move = repetition.no_act(state)
+            if free_move >= 2:
+                # 作和棋处理
+                game_over = True
+                value = 0
+                logger.info("闲着循环三次，作和棋处理")
         if game_over:
             break
         start_time = time()
@@ -265,6 +256,7 @@ def self_play_buffer(config, pipes_bt, pipes_ng, idx, res_data) -> (tuple, list)
         print(f"博弈中: 回合{turns / 2 + 1} {'红方走棋' if turns % 2 == 0 else '黑方走棋'}, 着法: {action}, 用时: {(end_time - start_time):.1f}s")
         # policys.append(policy)
         history.append(action)
+        repetition.play(action)
         try:
             state, no_eat = senv.new_step(state, action)
         except Exception as e:
@@ -277,6 +269,7 @@ def self_play_buffer(config, pipes_bt, pipes_ng, idx, res_data) -> (tuple, list)
         else:
             no_eat_count = 0
         history.append(state)
+        repetition.push(state)
 
         if no_eat_count >= 120 or turns / 2 >= config.play.max_game_length:
             game_over = True
@@ -289,7 +282,7 @@ def self_play_buffer(config, pipes_bt, pipes_ng, idx, res_data) -> (tuple, list)
                     game_over = True
                     value = 0
 
-    if final_move:
+    if final_move is not None:
         history.append(final_move)
         state = senv.step(state, final_move)
         turns += 1
@@ -304,7 +297,6 @@ def self_play_buffer(config, pipes_bt, pipes_ng, idx, res_data) -> (tuple, list)
     player1.close()
     player2.close()
     del player1, player2
-    gc.collect()
 
     if turns % 2 == 1:  # balck turn
         value = -value
@@ -322,10 +314,9 @@ def self_play_buffer(config, pipes_bt, pipes_ng, idx, res_data) -> (tuple, list)
 
 def build_policy(action, flip):
     labels_n = len(ActionLabelsRed)
-    move_lookup = {move: i for move, i in zip(ActionLabelsRed, range(labels_n))}
     policy = np.zeros(labels_n)
 
-    policy[move_lookup[action]] = 1
+    policy[move_to_id(action)] = 1  # action: move id or move string of old data
 
     if flip:
         policy = flip_policy(policy)
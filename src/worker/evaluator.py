@@ -4,11 +4,10 @@ from concurrent.futures import ProcessPoolExecutor, wait
 from logging import getLogger
 from multiprocessing import Manager
 from time import time, sleep
-from collections import defaultdict
 
 import src.environment.light.static_env as senv
 from src.agent.model import CChessModel
-from src.agent.mcts import CChessPlayer, VisitState
+from src.agent.mcts import CChessPlayer, SearchTree
 from src.config import Config
 from src.utils.model_helper import load_model_weight
 from src.utils.tf_helper import set_session_config
@@ -88,8 +87,8 @@ class EvaluateWorker:
     def start_game(self, idx):
         pipe1 = self.pipes_bt.pop()
         pipe2 = self.pipes_ng.pop()
-        search_tree1 = defaultdict(VisitState)
-        search_tree2 = defaultdict(VisitState)
+        search_tree1 = SearchTree()
+        search_tree2 = SearchTree()
 
         self.player1 = CChessPlayer(self.config, search_tree=search_tree1, pipes=pipe1, 
                         debugging=False, enable_resign=True)
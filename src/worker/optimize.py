@@ -14,7 +14,8 @@ from src.config import Config
 from src.utils.data_helper import get_game_data_filenames, read_game_data_from_file
 from src.utils.model_helper import load_best_model_weight
 from src.utils.model_helper import need_to_reload_best_model_weight, save_as_next_generation_model, save_as_best_model
-from src.environment.light.lookup_tables import ActionLabelsRed, flip_policy
+from src.environment.light.lookup_tables import ActionLabelsRed, flip_policy, mirror_policy, move_to_id
+from src.environment.light.planes import mirror_planes
 from src.utils.tf_helper import set_session_config
 from keras.optimizers import SGD
 from keras.callbacks import TensorBoard
@@ -104,23 +105,36 @@ class OptimizeWorker:
         tc = self.config.trainer
         state_ary, policy_ary, value_ary = self.collect_all_loaded_data()
         tensorboard_cb = TensorBoard(log_dir="./logs", batch_size=tc.batch_size, histogram_freq=1)
-        if self.config.opts.use_multiple_gpus:
-            self.mg_model.fit(state_ary, [policy_ary, value_ary],
-                              batch_size=tc.batch_size,
-                              epochs=epochs,
-                              shuffle=True,
-                              validation_split=0.02,
-                              callbacks=[tensorboard_cb])
-        else:
-            self.model.model.fit(state_ary, [policy_ary, value_ary],
-                                 batch_size=tc.batch_size,
-                                 epochs=epochs,
-                                 shuffle=True,
-                                 validation_split=0.02,
-                                 callbacks=[tensorboard_cb])
+        model = self.mg_model if self.config.opts.use_multiple_gpus else self.model.model
+        if tc.mirror_augmentation:
+            return self.train_epoch_mirrored(model, epochs, state_ary, policy_ary, value_ary, tensorboard_cb)
+        model.fit(state_ary, [policy_ary, value_ary],
+                  batch_size=tc.batch_size,
+                  epochs=epochs,
+                  shuffle=True,
+                  validation_split=0.02,
+                  callbacks=[tensorboard_cb])
         steps = (state_ary.shape[0] // tc.batch_size) * epochs
         return steps
 
+    def train_epoch_mirrored(self, model, epochs, state_ary, policy_ary, value_ary, tensorboard_cb):
+        '''
+        Train on every position and its left-right mirror, the mirrors are made batch by batch
+        '''
+        tc = self.config.trainer
+        n_train = max(int(state_ary.shape[0] * 0.98), 1)
+        steps_per_epoch = max(n_train * 2 // tc.batch_size, 1)
+        validation = None
+        if n_train < state_ary.shape[0]:
+            validation = (state_ary[n_train:], [policy_ary[n_train:], value_ary[n_train:]])
+        model.fit_generator(mirror_batches(state_ary[:n_train], policy_ary[:n_train], value_ary[:n_train],
+                                           tc.batch_size),
+                            steps_per_epoch=steps_per_epoch,
+                            epochs=epochs,
+                            validation_data=validation,
+                            callbacks=[tensorboard_cb])
+        return steps_per_epoch * epochs
+
     def compile_model(self):
         self.opt = SGD(lr=0.02, momentum=self.config.trainer.momentum)
         losses = ['categorical_crossentropy', 'mean_squared_error']
@@ -233,53 +247,83 @@ def expanding_data(data, use_history=False):
         history = [state]
     else:
         history = None
-    for item in data[1:]:
+    plies = []  # ply of every sample
+    for ply, item in enumerate(data[1:]):
         action = item[0]
         value = item[1]
         try:
-            policy = build_policy(action, flip=False)
+            if len(item) > 2:  # playout cap randomisation: visit share target, None if not a training target
+                policy = build_target_policy(item[2]) if item[2] is not None else None
+            else:
+                policy = build_policy(action, flip=False)
         except Exception as e:
             logger.error(f"Expand data error {e}, item = {item}, data = {data}, state = {state}")
             return None
-        real_data.append([state, policy, value])
+        if policy is not None:
+            real_data.append([state, policy, value])
+            plies.append(ply)
         state = senv.step(state, action)
         if use_history:
             history.append(action)
             history.append(state)
 
-    return convert_to_trainging_data(real_data, history)
-
-
-def convert_to_trainging_data(data, history):
-    state_list = []
-    policy_list = []
-    value_list = []
-    i = 0
-
-    for state, policy, value in data:
-        if history is None:
-            state_planes = senv.state_to_planes(state)
-        else:
-            state_planes = senv.state_history_to_planes(state, history[0:i * 2 + 1])
-        sl_value = value
+    if not real_data:
+        return None
+    return convert_to_trainging_data(real_data, history, plies)
 
-        state_list.append(state_planes)
-        policy_list.append(policy)
-        value_list.append(sl_value)
-        i += 1
 
-    return np.asarray(state_list, dtype=np.float32), \
+def convert_to_trainging_data(data, history, plies=None):
+    states = [state for state, _, _ in data]
+    if history is None:
+        last_states = None
+    else:
+        if plies is None:
+            plies = range(len(data))
+        # history[0:i * 2 + 1][-5] is the last state of the i-th state
+        last_states = [history[i * 2 - 4] if i >= 2 else None for i in plies]
+    state_array = senv.states_to_planes(states, last_states)
+    policy_list = [policy for _, policy, _ in data]
+    value_list = [value for _, _, value in data]
+
+    return state_array, \
            np.asarray(policy_list, dtype=np.float32), \
            np.asarray(value_list, dtype=np.float32)
 
 
+def mirror_batches(state_ary, policy_ary, value_ary, batch_size):
+    '''
+    Endless shuffled batches of batch_size samples: batch_size / 2 positions and their left-right mirrors,
+    smaller when there are fewer positions
+    '''
+    half = max(min(batch_size // 2, state_ary.shape[0]), 1)
+    while True:
+        order = np.random.permutation(state_ary.shape[0])
+        for start in range(0, len(order) - half + 1, half):
+            idx = np.sort(order[start:start + half])
+            states, policies, values = state_ary[idx], policy_ary[idx], value_ary[idx]
+            yield np.concatenate([states, mirror_planes(states)]), \
+                  [np.concatenate([policies, mirror_policy(policies)]), np.concatenate([values, values])]
+
+
 def build_policy(action, flip):
     labels_n = len(ActionLabelsRed)
-    move_lookup = {move: i for move, i in zip(ActionLabelsRed, range(labels_n))}
     policy = np.zeros(labels_n)
 
-    policy[move_lookup[action]] = 1
+    policy[move_to_id(action)] = 1  # action: move id or move string of old data
 
     if flip:
         policy = flip_policy(policy)
     return list(policy)
+
+
+def build_target_policy(target):
+    '''
+    [[move id, visit share]] of a full search -> policy, renormalised (the shares are rounded)
+    '''
+    policy = np.zeros(len(ActionLabelsRed))
+    for move, share in target:
+        policy[move] = share
+    total = policy.sum()
+    if total > 0:
+        policy /= total
+    return list(policy)
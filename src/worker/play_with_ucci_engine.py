@@ -1,5 +1,4 @@
 import os
-import gc
 import subprocess
 import numpy as np
 from concurrent.futures import ProcessPoolExecutor
@@ -7,14 +6,14 @@ from datetime import datetime
 from logging import getLogger
 from multiprocessing import Manager
 from time import time
-from collections import defaultdict
 from random import random
 
 import src.environment.light.static_env as senv
+from src.environment.light.repetition import RepetitionTracker
 from src.agent.model import CChessModel
-from src.agent.mcts import CChessPlayer, VisitState
+from src.agent.mcts import CChessPlayer, SearchTree
 from src.config import Config
-from src.environment.light.lookup_tables import ActionLabelsRed, flip_policy, flip_move
+from src.environment.light.lookup_tables import ActionLabelsRed, flip_policy, flip_move, move_to_id
 from src.utils.data_helper import get_game_data_filenames, write_game_data_to_file
 from src.utils.model_helper import load_best_model_weight, save_as_best_model
 from src.utils.tf_helper import set_session_config
@@ -61,7 +60,7 @@ class SelfPlayWorker:
         self.buffer = []
 
         while True:
-            search_tree = defaultdict(VisitState)
+            search_tree = SearchTree()
             start_time = time()
             value, turns, state, store = self.start_game(idx, search_tree)
             end_time = time()
@@ -84,7 +83,7 @@ class SelfPlayWorker:
 
         if not self.config.play.share_mtcs_info_in_self_play or \
             idx % self.config.play.reset_mtcs_info_per_game == 0:
-            search_tree = defaultdict(VisitState)
+            search_tree = SearchTree()
 
         if random() > self.config.play.enable_resign_rate:
             enable_resign = True
@@ -95,6 +94,7 @@ class SelfPlayWorker:
 
         state = senv.INIT_STATE
         history = [state]
+        repetition = RepetitionTracker(state)
         value = 0
         turns = 0       # even == red; odd == black
         game_over = False
@@ -105,11 +105,8 @@ class SelfPlayWorker:
         while not game_over:
             if (is_alpha_red and turns % 2 == 0) or (not is_alpha_red and turns % 2 == 1):
                 no_act = None
-                if not check and state in history[:-1]:
-                    no_act = []
-                    for i in range(len(history) - 1):
-                        if history[i] == state:
-                            no_act.append(history[i + 1])
+                if not check and repetition.is_repeated():
+                    no_act = repetition.previous_actions()
                 action, _ = self.player.action(state, turns, no_act)
                 if action is None:
                     logger.debug(f"{turns % 2} (0 = red; 1 = black) has resigned!")
@@ -124,10 +121,13 @@ class SelfPlayWorker:
                     break
                 if turns % 2 == 1:
                     action = flip_move(action)
+                action = move_to_id(action)
             history.append(action)
+            repetition.play(action)
             state = senv.step(state, action)
             turns += 1
             history.append(state)
+            repetition.push(state)
 
             if turns / 2 >= self.config.play.max_game_length:
                 game_over = True
@@ -135,7 +135,7 @@ class SelfPlayWorker:
             else:
                 game_over, value, final_move, check = senv.done(state, need_check=True)
 
-        if final_move:
+        if final_move is not None:
             history.append(final_move)
             state = senv.step(state, final_move)
             history.append(state)
@@ -145,7 +145,6 @@ class SelfPlayWorker:
         self.player.close()
         del search_tree
         del self.player
-        gc.collect()
         if turns % 2 == 1:  # balck turn
             value = -value
 
@@ -221,10 +220,9 @@ class SelfPlayWorker:
 
     def build_policy(self, action, flip):
         labels_n = len(ActionLabelsRed)
-        move_lookup = {move: i for move, i in zip(ActionLabelsRed, range(labels_n))}
         policy = np.zeros(labels_n)
 
-        policy[move_lookup[action]] = 1
+        policy[move_to_id(action)] = 1  # action: move id or move string of old data
 
         if flip:
             policy = flip_policy(policy)
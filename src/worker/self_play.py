@@ -1,20 +1,21 @@
 import os
-import gc
 import numpy as np
+from copy import copy
 from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timezone, timedelta
 from logging import getLogger
 from multiprocessing import Manager
 from time import time, sleep
-from collections import defaultdict
 from random import random
 from threading import Thread
 
 import src.environment.light.static_env as senv
+from src.environment.light.repetition import RepetitionTracker
 from src.agent.model import CChessModel
-from src.agent.mcts import CChessPlayer, VisitState
+from src.agent.api import SharedEvalTable
+from src.agent.mcts import CChessPlayer, SearchTree, EvalCache
 from src.config import Config
-from src.environment.light.lookup_tables import ActionLabelsRed, flip_policy
+from src.environment.light.lookup_tables import ActionLabelsRed, flip_policy, move_to_id
 from src.utils.data_helper import get_game_data_filenames, write_game_data_to_file
 from src.utils.model_helper import load_best_model_weight, save_as_best_model
 from src.utils.tf_helper import set_session_config
@@ -33,23 +34,31 @@ def start(config: Config):
     current_model = load_model(config)
     m = Manager()
     cur_pipes = m.list([current_model.get_pipes() for _ in range(config.play.max_processes)])
+    table_name = current_model.get_eval_table(config.play.shared_cache_slots)
+    generation = current_model.get_generation(m)
     # play_worker = SelfPlayWorker(config, cur_pipes, 0)
     # play_worker.start()
     with ProcessPoolExecutor(max_workers=config.play.max_processes) as executor:
         futures = []
         for i in range(config.play.max_processes):
-            play_worker = SelfPlayWorker(config, cur_pipes, i)
+            play_worker = SelfPlayWorker(config, cur_pipes, i, table_name, generation)
             logger.debug("Initialize selfplay worker")
             futures.append(executor.submit(play_worker.start))
 
 class SelfPlayWorker:
-    def __init__(self, config: Config, pipes=None, pid=None):
+    def __init__(self, config: Config, pipes=None, pid=None, table_name=None, generation=None):
         self.config = config
+        self.play_config = copy(config.play)
+        self.play_config.early_stop = True  # the greedy moves of self-play do not need a full search
         self.player = None
         self.cur_pipes = pipes
         self.id = pid
         self.buffer = []
         self.pid = os.getpid()
+        self.eval_cache = None
+        self.table_name = table_name  # SharedEvalTable of the prediction server
+        self.eval_table = None
+        self.generation = generation  # model generation of the prediction server, see EvalCache.sync
 
     def start(self):
         self.pid = os.getpid()
@@ -57,123 +66,80 @@ class SelfPlayWorker:
 
         idx = 1
         self.buffer = []
-        search_tree = defaultdict(VisitState)
+        self.eval_cache = EvalCache(self.config.play.eval_cache_size, self.generation)  # kept across the games of the process
+        if self.table_name:
+            self.eval_table = SharedEvalTable(self.config.play.shared_cache_slots, name=self.table_name)
+        try:
+            if self.config.play.parallel_games > 1:
+                self.start_games(idx)
+            search_tree = SearchTree()
 
-        while True:
-            start_time = time()
-            search_tree = defaultdict(VisitState)
-            value, turns, state, store = self.start_game(idx, search_tree)
-            end_time = time()
-            logger.debug(f"Process {self.pid}-{self.id} play game {idx} time={(end_time - start_time):.1f} sec, "
-                         f"turn={turns / 2}, winner = {value:.2f} (1 = red, -1 = black, 0 draw)")
-            if turns <= 10:
-                senv.render(state)
-            if store:
-                idx += 1
-            sleep(random())
+            while True:
+                start_time = time()
+                search_tree = SearchTree()
+                value, turns, state, store = self.start_game(idx, search_tree)
+                self.log_game(idx, value, turns, state, time() - start_time)
+                if store:
+                    idx += 1
+                sleep(random())
+        finally:
+            if self.eval_table is not None:
+                self.eval_table.close()  # detach only, CChessModelAPI owns the segment and unlinks it
+                self.eval_table = None
+
+    def log_game(self, idx, value, turns, state, seconds):
+        logger.debug(f"Process {self.pid}-{self.id} play game {idx} time={seconds:.1f} sec, "
+                     f"turn={turns / 2}, winner = {value:.2f} (1 = red, -1 = black, 0 draw), "
+                     f"eval cache hit rate = {self.eval_cache.hit_rate:.2f} ({len(self.eval_cache)} entries)"
+                     + (f", shared table hit rate = {self.eval_table.hit_rate:.2f}" if self.eval_table else ""))
+        if turns <= 10:
+            senv.render(state)
+
+    def enable_resign(self):
+        return random() > self.config.play.enable_resign_rate
 
     def start_game(self, idx, search_tree):
         pipes = self.cur_pipes.pop()
 
         if not self.config.play.share_mtcs_info_in_self_play or \
             idx % self.config.play.reset_mtcs_info_per_game == 0:
-            search_tree = defaultdict(VisitState)
+            search_tree = SearchTree()
 
-        if random() > self.config.play.enable_resign_rate:
-            enable_resign = True
-        else:
-            enable_resign = False
-
-        self.player = CChessPlayer(self.config, search_tree=search_tree, pipes=pipes, enable_resign=enable_resign, debugging=False)
-
-        state = senv.INIT_STATE
-        history = [state]
-        # policys = [] 
-        value = 0
-        turns = 0       # even == red; odd == black
-        game_over = False
-        final_move = None
-        no_eat_count = 0
-        check = False
-
-        while not game_over:
-            no_act = None
-            if not check and state in history[:-1]:
-                no_act = []
-                free_move = defaultdict(int)
-                for i in range(len(history) - 1):
-                    if history[i] == state:
-                        # 如果走了下一步是将军或捉：禁止走那步
-                        if senv.will_check_or_catch(state, history[i+1]):
-                            no_act.append(history[i + 1])
-                        # 否则当作闲着处理
-                        else:
-                            free_move[state] += 1
-                            if free_move[state] >= 2:
-                                # 作和棋处理
-                                game_over = True
-                                value = 0
-                                logger.info("闲着循环三次，作和棋处理")
-                                break
-            if game_over:
+        self.player = CChessPlayer(self.config, search_tree=search_tree, pipes=pipes, play_config=self.play_config,
+                                   enable_resign=self.enable_resign(), debugging=False, eval_cache=self.eval_cache,
+                                   eval_table=self.eval_table)
+        game = SelfPlayGame(self.config, self.player)
+
+        while not game.game_over:
+            no_act = game.next_no_act()
+            if game.game_over:
                 break
             start_time = time()
-            action, policy = self.player.action(state, turns, no_act)
+            action, policy = self.player.action(game.state, game.turns, no_act, **game.search_args())
             end_time = time()
-            if action is None:
-                logger.debug(f"{turns % 2} (0 = red; 1 = black) has resigned!")
-                value = -1
-                break
-            if self.config.opts.log_move:
-                logger.info(f"Process{self.pid} Playing: {turns % 2}, action: {action}, time: {(end_time - start_time):.1f}s")
+            if action is not None and self.config.opts.log_move:
+                logger.info(f"Process{self.pid} Playing: {game.turns % 2}, action: {action}, time: {(end_time - start_time):.1f}s")
             # logger.info(f"Process{self.pid} Playing: {turns % 2}, action: {action}, time: {(end_time - start_time):.1f}s")
             # for move, action_state in self.player.search_results.items():
             #     if action_state[0] >= 20:
             #         logger.info(f"move: {move}, prob: {action_state[0]}, Q_value: {action_state[1]:.2f}, Prior: {action_state[2]:.3f}")
             # self.player.search_results = {}
-            history.append(action)
-            # policys.append(policy)
-            try:
-                state, no_eat = senv.new_step(state, action)
-            except Exception as e:
-                logger.error(f"{e}, no_act = {no_act}, policy = {policy}")
-                game_over = True
-                value = 0
-                break
-            turns += 1
-            if no_eat:
-                no_eat_count += 1
-            else:
-                no_eat_count = 0
-            history.append(state)
-
-            if no_eat_count >= 120 or turns / 2 >= self.config.play.max_game_length:
-                game_over = True
-                value = 0
-            else:
-                game_over, value, final_move, check = senv.done(state, need_check=True)
-                if not game_over:
-                    if not senv.has_attack_chessman(state):
-                        logger.info(f"双方无进攻子力，作和。state = {state}")
-                        game_over = True
-                        value = 0
-
-        if final_move:
-            # policy = self.build_policy(final_move, False)
-            history.append(final_move)
-            # policys.append(policy)
-            state = senv.step(state, final_move)
-            turns += 1
-            value = -value
-            history.append(state)
+            game.play(action, policy)
 
         self.player.close()
         del search_tree
         del self.player
-        gc.collect()
-        if turns % 2 == 1:  # balck turn
-            value = -value
+        v, turns, state, store = self.end_game(idx, game)
+        self.cur_pipes.append(pipes)
+        self.remove_play_data()
+        return v, turns, state, store
 
+    def end_game(self, idx, game):
+        '''
+        Play the final move of a finished game and save its data
+        return (value of red, turns, final state, stored)
+        '''
+        value, turns, state, history = game.finish()
         v = value
         if turns < 10:
             if random() > 0.9:
@@ -187,14 +153,81 @@ class SelfPlayWorker:
             data = [history[0]]
             for i in range(turns):
                 k = i * 2
-                data.append([history[k + 1], value])
+                if game.targets is None:
+                    data.append([history[k + 1], value])
+                else:
+                    data.append([history[k + 1], value, game.targets[i]])
                 value = -value
             self.save_play_data(idx, data)
-
-        self.cur_pipes.append(pipes)
-        self.remove_play_data()
         return v, turns, state, store
 
+    def start_games(self, idx):
+        '''
+        Play parallel_games games at once in lock-step, forever. Every step gathers the leaves of all
+        the searching trees into one prediction request: the NN batch is up to
+        parallel_games * search_threads leaves while every tree only has search_threads in flight
+        '''
+        pipes = self.cur_pipes.pop()
+        play_config = copy(self.play_config)
+        play_config.search_driver = 'batched'  # the players are stepped from here, no threads
+        batch_size = play_config.search_threads
+        games = [self.new_game(play_config) for _ in range(play_config.parallel_games)]
+        out = np.zeros(shape=(len(games) * batch_size, 28 if games[0].player.use_history else 14, 10, 9),
+                       dtype=np.float32)
+        start_times = [time()] * len(games)
+
+        while True:
+            searching = []
+            for game in games:
+                no_act = game.next_no_act()
+                if not game.game_over:
+                    game.player.start_search(game.state, game.turns, no_act, **game.search_args())
+                    if not game.player.search_done():
+                        searching.append(game.player)
+
+            while searching:
+                requests = []  # (player, leaves) in the order of the request
+                keys = []
+                size = 0
+                for player in searching:
+                    leaves = player.collect_leaves(batch_size)
+                    if leaves:
+                        states, lasts, _ = zip(*leaves)
+                        player.encode(states, lasts, out[size:size + len(leaves)])
+                        keys.extend(player.table_keys(states, lasts))
+                        requests.append((player, leaves))
+                        size += len(leaves)
+                if size:
+                    pipes.send((out[:size], keys))
+                    rets, generation = pipes.recv()
+                    for player, leaves in requests:
+                        player.apply_predictions(leaves, rets[:len(leaves)], generation)
+                        rets = rets[len(leaves):]
+                for player in searching:
+                    if not player.resumed:
+                        player.bound_tree()
+                searching = [player for player in searching if not player.search_done()]
+
+            for i, game in enumerate(games):
+                if not game.game_over:
+                    action, policy = game.player.choose_action(game.turns)
+                    game.play(action, policy)
+                if game.game_over:
+                    game.player.close()
+                    value, turns, state, store = self.end_game(idx, game)
+                    self.log_game(idx, value, turns, state, time() - start_times[i])
+                    if store:
+                        idx += 1
+                    self.remove_play_data()
+                    games[i] = self.new_game(play_config)
+                    start_times[i] = time()
+
+    def new_game(self, play_config):
+        player = CChessPlayer(self.config, search_tree=SearchTree(), play_config=play_config,
+                              enable_resign=self.enable_resign(), debugging=False, eval_cache=self.eval_cache,
+                              eval_table=self.eval_table)
+        return SelfPlayGame(self.config, player)
+
     def save_play_data(self, idx, data):
         self.buffer += data
 
@@ -224,12 +257,120 @@ class SelfPlayWorker:
 
     def build_policy(self, action, flip):
         labels_n = len(ActionLabelsRed)
-        move_lookup = {move: i for move, i in zip(ActionLabelsRed, range(labels_n))}
         policy = np.zeros(labels_n)
 
-        policy[move_lookup[action]] = 1
+        policy[move_to_id(action)] = 1  # action: move id or move string of old data
 
         if flip:
             policy = flip_policy(policy)
         return list(policy)
 
+
+
+class SelfPlayGame:
+    '''
+    One self-play game of `player`, advanced one move at a time
+    '''
+    def __init__(self, config: Config, player):
+        self.config = config
+        self.player = player
+        self.state = senv.INIT_STATE
+        self.history = [self.state]
+        self.repetition = RepetitionTracker(self.state)
+        self.value = 0
+        self.turns = 0       # even == red; odd == black
+        self.game_over = False
+        self.final_move = None
+        self.no_eat_count = 0
+        self.check = False
+        self.no_act = None
+        # playout cap randomisation: policy target of every move, [[move id, visit share]] or None
+        self.targets = [] if config.play.full_search_prob < 1 else None
+        self.full_search = True
+
+    def next_no_act(self):
+        '''
+        The forbidden moves of the side to move, the game ends in a draw after three idle loops
+        '''
+        self.no_act = None
+        if not self.check and self.repetition.is_repeated():
+            # 如果走了下一步是将军或捉：禁止走那步，否则当作闲着处理
+            self.no_act, free_move = self.repetition.no_act(self.state)
+            if free_move >= 2:
+                # 作和棋处理
+                self.game_over = True
+                self.value = 0
+                logger.info("闲着循环三次，作和棋处理")
+        return self.no_act
+
+    def search_args(self):
+        '''
+        Playout cap randomisation: a full search (a training target) with probability full_search_prob,
+        else a fast search of fast_search_num simulations without noise
+        return the extra arguments of the search
+        '''
+        pc = self.config.play
+        self.full_search = self.targets is None or random() < pc.full_search_prob
+        if self.full_search:
+            return {}
+        return {'depth': pc.fast_search_num, 'noise': False}
+
+    def play(self, action, policy):
+        '''
+        Play the searched move, None to resign
+        '''
+        if action is None:
+            logger.debug(f"{self.turns % 2} (0 = red; 1 = black) has resigned!")
+            self.game_over = True
+            self.value = -1
+            return
+        if self.targets is not None:
+            self.targets.append([[i, round(p, 4)] for i, p in enumerate(policy) if p > 0] if self.full_search else None)
+        self.history.append(action)
+        self.repetition.play(action)
+        # policys.append(policy)
+        try:
+            self.state, no_eat = senv.new_step(self.state, action)
+        except Exception as e:
+            logger.error(f"{e}, no_act = {self.no_act}, policy = {policy}")
+            self.game_over = True
+            self.value = 0
+            return
+        self.turns += 1
+        if no_eat:
+            self.no_eat_count += 1
+        else:
+            self.no_eat_count = 0
+        self.history.append(self.state)
+        self.repetition.push(self.state)
+
+        if self.no_eat_count >= 120 or self.turns / 2 >= self.config.play.max_game_length:
+            self.game_over = True
+            self.value = 0
+        else:
+            self.game_over, self.value, self.final_move, self.check = senv.done(self.state, need_check=True)
+            if not self.game_over:
+                if not senv.has_attack_chessman(self.state):
+                    logger.info(f"双方无进攻子力，作和。state = {self.state}")
+                    self.game_over = True
+                    self.value = 0
+
+    def finish(self):
+        '''
+        Play the final move of the finished game
+        return (value of red, turns, final state, history)
+        '''
+        value = self.value
+        if self.final_move is not None:
+            # policy = self.build_policy(final_move, False)
+            self.history.append(self.final_move)
+            # policys.append(policy)
+            if self.targets is not None:
+                self.targets.append([[self.final_move, 1]])
+            self.state = senv.step(self.state, self.final_move)
+            self.turns += 1
+            value = -value
+            self.history.append(self.state)
+        if self.turns % 2 == 1:  # balck turn
+            value = -value
+        return value, self.turns, self.state, self.history
@@ -1,5 +1,4 @@
 import os
-import gc
 import numpy as np
 from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
@@ -7,15 +6,15 @@ from logging import getLogger
 from multiprocessing import Manager
 from threading import Thread
 from time import time
-from collections import defaultdict
 from threading import Lock
 from random import random
 
 import src.environment.light.static_env as senv
+from src.environment.light.repetition import RepetitionTracker
 from src.agent.model import CChessModel
-from src.agent.mcts import CChessPlayer, VisitState
+from src.agent.mcts import CChessPlayer, SearchTree
 from src.config import Config
-from src.environment.light.lookup_tables import ActionLabelsRed, flip_policy
+from src.environment.light.lookup_tables import ActionLabelsRed, flip_policy, move_to_id
 from src.utils.data_helper import get_game_data_filenames, write_game_data_to_file
 from src.utils.model_helper import load_best_model_weight, save_as_best_model
 from src.utils.tf_helper import set_session_config
@@ -146,11 +145,12 @@ def self_play_buffer(config, cur) -> (tuple, list):
     else:
         enable_resign = False
 
-    player = CChessPlayer(config, search_tree=defaultdict(VisitState), pipes=pipe, enable_resign=enable_resign,
+    player = CChessPlayer(config, search_tree=SearchTree(), pipes=pipe, enable_resign=enable_resign,
                           debugging=False)
 
     state = senv.INIT_STATE
     history = [state]
+    repetition = RepetitionTracker(state)
     # policys = [] 
     value = 0
     turns = 0
@@ -161,23 +161,14 @@ def self_play_buffer(config, cur) -> (tuple, list):
 
     while not game_over:
         no_act = None
-        if not check and state in history[:-1]:
-            no_act = []
-            free_move = defaultdict(int)
-            for i in range(len(history) - 1):
-                if history[i] == state:
-                    # 如果走了下一步是将军或捉：禁止走那步
-                    if senv.will_check_or_catch(state, history[i + 1]):
-                        no_act.append(history[i + 1])
-                    # 否则当作闲着处理
-                    else:
-                        free_move[state] += 1
-                        if free_move[state] >= 2:
-                            # 作和棋处理
-                            game_over = True
-                            value = 0
-                            logger.info("闲着循环三次，作和棋处理")
-                            break
+        if not check and repetition.is_repeated():
+            # 如果走了下一步是将军或捉：禁止走那步，否则当作闲着处理
+            no_act, free_move = repetition.no_act(state)
+            if free_move >= 2:
+                # 作和棋处理
+                game_over = True
+                value = 0
+                logger.info("闲着循环三次，作和棋处理")
         if game_over:
             break
         start_time = time()
@@ -191,6 +182,7 @@ def self_play_buffer(config, cur) -> (tuple, list):
             f"博弈中: 回合{turns / 2 + 1} {'红方走棋' if turns % 2 == 0 else '黑方走棋'}, 着法: {action}, 用时: {(end_time - start_time):.1f}s")
         # policys.append(policy)
         history.append(action)
+        repetition.play(action)
         try:
             state, no_eat = senv.new_step(state, action)
         except Exception as e:
@@ -204,6 +196,7 @@ def self_play_buffer(config, cur) -> (tuple, list):
         else:
             no_eat_count = 0
         history.append(state)
+        repetition.push(state)
 
         if no_eat_count >= 120 or turns / 2 >= config.play.max_game_length:
             game_over = True
@@ -216,7 +209,7 @@ def self_play_buffer(config, cur) -> (tuple, list):
                     game_over = True
                     value = 0
 
-    if final_move:
+    if final_move is not None:
         # policy = build_policy(final_move, False)
         history.append(final_move)
         # policys.append(policy)
@@ -227,7 +220,6 @@ def self_play_buffer(config, cur) -> (tuple, list):
 
     player.close()
     del player
-    gc.collect()
 
     if turns % 2 == 1:  # balck turn
         value = -value
@@ -245,10 +237,9 @@ def self_play_buffer(config, cur) -> (tuple, list):
 
 def build_policy(action, flip):
     labels_n = len(ActionLabelsRed)
-    move_lookup = {move: i for move, i in zip(ActionLabelsRed, range(labels_n))}
     policy = np.zeros(labels_n)
 
-    policy[move_lookup[action]] = 1
+    policy[move_to_id(action)] = 1  # action: move id or move string of old data
 
     if flip:
         policy = flip_policy(policy)